@@ -0,0 +1,66 @@
+import numpy as np
+
+
+# geometric augmentation on rasterized drawings
+#
+# the same random rotation, scale and translation about the image center is
+# applied to the alpha of a drawing and to its path stack, so a sample costs
+# one bilinear warp instead of re-rendering a transformed svg.
+# the parameters travel with the sampling calls, None: no augmentation
+
+def augment_params(config):
+    if not config.augment:
+        return None
+    return {
+        'rotate': config.max_rotate, # degree
+        'scale': (config.min_scale, config.max_scale),
+        'translate': config.max_translate, # fraction of image size
+    }
+
+def random_transform(rng, h, w, rotate, scale, translate):
+    """Random 2x3 affine matrix in (x, y) pixel coordinates."""
+    r = np.deg2rad(rng.uniform(-rotate, rotate))
+    s = rng.uniform(scale[0], scale[1], size=2)
+    t = rng.uniform(-translate, translate, size=2) * [w, h]
+
+    a = np.dot([[np.cos(r), -np.sin(r)],
+                [np.sin(r),  np.cos(r)]], np.diag(s))
+    c = np.array([w-1, h-1]) * 0.5
+    return np.hstack((a, (c + t - np.dot(a, c))[:,np.newaxis]))
+
+def warp(images, m):
+    """Warp a uint8 [n, h, w] stack by the 2x3 affine matrix m, bilinear,
+    zero outside."""
+    n, h, w = images.shape
+    a_inv = np.linalg.inv(m[:,:2])
+    y, x = np.mgrid[:h, :w].astype(np.float32)
+    p = np.dot(a_inv, np.stack((x.ravel() - m[0,2], y.ravel() - m[1,2])))
+    sx, sy = p[0].reshape([h, w]), p[1].reshape([h, w])
+
+    x0 = np.floor(sx).astype(np.int64)
+    y0 = np.floor(sy).astype(np.int64)
+    fx = (sx - x0).astype(np.float32)
+    fy = (sy - y0).astype(np.float32)
+
+    # one pixel of zero padding takes care of the border
+    padded = np.zeros([n, h+2, w+2], dtype=np.float32)
+    padded[:,1:-1,1:-1] = images
+    x1 = np.clip(x0+1, -1, w) + 1
+    y1 = np.clip(y0+1, -1, h) + 1
+    x0 = np.clip(x0, -1, w) + 1
+    y0 = np.clip(y0, -1, h) + 1
+
+    out = (padded[:,y0,x0] * ((1-fx)*(1-fy)) + padded[:,y0,x1] * (fx*(1-fy)) +
+           padded[:,y1,x0] * ((1-fx)*fy) + padded[:,y1,x1] * (fx*fy))
+    return np.round(out).astype(np.uint8)
+
+def augment(s, masks, rng, params):
+    """Randomly transform the uint8 alpha s [h, w] and masks [n, h, w]
+    with augment_params() params."""
+    if params is None:
+        return s, masks
+
+    h, w = s.shape
+    m = random_transform(rng, h, w, **params)
+    out = warp(np.concatenate((s[np.newaxis], masks)), m)
+    return out[0], out[1:]
@@ -0,0 +1,79 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+
+# scaling benchmark of synchronous data-parallel training
+#
+# for each number of workers, starts one ps and the workers on localhost,
+# trains --max_step steps and reports the throughput printed by the chief.
+# other arguments are passed on to main.py, i.e.
+#
+#   python bench_sync.py --num_workers=1,2,4,8 --dataset=ch --warmup_batches=10
+
+def run(n, port, max_step, num_cpu, log_dir, main_args):
+    ps_hosts = 'localhost:%d' % port
+    worker_hosts = ','.join('localhost:%d' % (port+1+i) for i in range(n))
+    args = [sys.executable, 'main.py',
+            '--ps_hosts=' + ps_hosts, '--worker_hosts=' + worker_hosts,
+            '--max_step=%d' % max_step, '--test_step=%d' % (max_step+1),
+            '--num_eval=%d' % 256, '--use_gpu=False',
+            '--num_thread=%d' % max(num_cpu // n, 1),
+            '--tag=bench%d' % n] + main_args
+
+    # cpu only
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+
+    def start(job_name, i):
+        log = open(os.path.join(log_dir, '%d_%s_%d.log' % (n, job_name, i)), 'w')
+        p = subprocess.Popen(args + ['--job_name=' + job_name, '--task_index=%d' % i],
+                             stdout=log, stderr=subprocess.STDOUT, env=env)
+        return p, log
+
+    ps = start('ps', 0)
+    workers = [start('worker', i) for i in range(n)]
+    for p, log in workers:
+        p.wait()
+        log.close()
+    ps[0].kill()
+    ps[0].wait()
+    ps[1].close()
+
+    with open(os.path.join(log_dir, '%d_worker_0.log' % n), 'r') as f:
+        m = re.search(r'([\d.]+) steps/sec, ([\d.]+) samples/sec', f.read())
+    if m is None:
+        return None
+    return float(m.group(1)), float(m.group(2))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers', type=str, default='1,2,4,8')
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--max_step', type=int, default=200)
+    parser.add_argument('--num_cpu', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--log_dir', type=str, default='log/bench_sync')
+    config, main_args = parser.parse_known_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if not os.path.exists(config.log_dir):
+        os.makedirs(config.log_dir)
+
+    result = []
+    for n in [int(n) for n in config.num_workers.split(',')]:
+        print('%s: %d workers' % (datetime.now(), n))
+        r = run(n, config.port, config.max_step, config.num_cpu, config.log_dir, main_args)
+        if r is None:
+            print('%s: %d workers failed, see %s' % (datetime.now(), n, config.log_dir))
+            continue
+        result.append((n,) + r)
+
+    print('workers  steps/sec  samples/sec  speedup')
+    for n, steps, samples in result:
+        print('%7d  %9.2f  %11.1f  %7.2f' % (n, steps, samples, samples / result[0][2]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import threading
+from datetime import datetime
+
+import tensorflow as tf
+
+
+class AsyncSaver(object):
+    """Copies the variables to host memory with one sess.run and writes the
+    checkpoint from a background thread, so the training loop only pays for
+    the copy. At most one snapshot waits for the writer, a newer one replaces
+    it. Checkpoints are regular Saver checkpoints, max_to_keep of them kept."""
+    def __init__(self, var_list, max_to_keep=5):
+        self.var_list = var_list
+
+        # host copy of the variables under the same names, written by its own saver
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.inputs = []
+            copies = []
+            for v in var_list:
+                x = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                copies.append(tf.Variable(x, name=v.op.name, trainable=False, collections=[]))
+                self.inputs.append(x)
+            self.assign = [c.initializer for c in copies]
+            self.saver = tf.train.Saver(copies, max_to_keep=max_to_keep)
+            self.sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self.pending = None
+        self.is_writing = False
+        self.is_closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, sess, save_path, global_step):
+        values = sess.run(self.var_list + [global_step])
+        with self.cond:
+            self.pending = (values[:-1], save_path, int(values[-1]))
+            self.cond.notify_all()
+
+    def write(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.is_closed:
+                    self.cond.wait()
+                if self.pending is None:
+                    return
+                values, save_path, step = self.pending
+                self.pending = None
+                self.is_writing = True
+
+            self.sess.run(self.assign, dict(zip(self.inputs, values)))
+            path = self.saver.save(self.sess, save_path, global_step=step,
+                                   write_meta_graph=False)
+            print('%s: checkpoint saved to %s' % (datetime.now(), path))
+
+            with self.cond:
+                self.is_writing = False
+                self.cond.notify_all()
+
+    def flush(self):
+        # wait until every snapshot is on disk
+        with self.cond:
+            while self.pending is not None or self.is_writing:
+                self.cond.wait()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.is_closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.sess.close()
@@ -23,7 +23,7 @@ net_arg.add_argument('--repeat_num', type=int, default=20,
 net_arg.add_argument('--use_l2', type=str2bool, default=True)
 net_arg.add_argument('--use_norm', type=str2bool, default=True)
 net_arg.add_argument('--archi', type=str, default='path',
-                     choices=['path','overlap'])
+                     choices=['path','overlap','joint'])
 
 # Data
 data_arg = add_argument_group('Data')
@@ -32,6 +32,22 @@ data_arg.add_argument('--dataset', type=str, default='line',
                       choices=['line','ch','kanji','baseball','cat'])
 data_arg.add_argument('--batch_size', type=int, default=8)
 data_arg.add_argument('--num_worker', type=int, default=16)
+data_arg.add_argument('--capacity', type=int, default=10000) # samples in queue
+data_arg.add_argument('--num_query', type=int, default=1) # PathNet samples per render
+data_arg.add_argument('--input_pipeline', type=str, default='queue',
+                      choices=['queue','dataset'])
+data_arg.add_argument('--producer', type=str, default='thread',
+                      choices=['thread','process'])
+data_arg.add_argument('--warmup_batches', type=int, default=-1) # -1: 80% of queue
+data_arg.add_argument('--use_snapshot', type=str2bool, default=False)
+data_arg.add_argument('--renderer', type=str, default='cairo',
+                      choices=['cairo','numpy'])
+data_arg.add_argument('--use_store', type=str2bool, default=False) # pre-rasterized samples
+data_arg.add_argument('--augment', type=str2bool, default=False)
+data_arg.add_argument('--max_rotate', type=float, default=45) # degree
+data_arg.add_argument('--min_scale', type=float, default=0.25)
+data_arg.add_argument('--max_scale', type=float, default=2.0)
+data_arg.add_argument('--max_translate', type=float, default=0.1) # fraction of size
 # line
 data_arg.add_argument('--num_strokes', type=int, default=4)
 data_arg.add_argument('--stroke_type', type=int, default=2)
@@ -51,6 +67,15 @@ train_arg.add_argument('--lr_lower_boundary', type=float, default=0.00001)
 train_arg.add_argument('--optimizer', type=str, default='adam')
 train_arg.add_argument('--beta1', type=float, default=0.5)
 train_arg.add_argument('--beta2', type=float, default=0.999)
+train_arg.add_argument('--num_accum', type=int, default=1) # micro-batches per Adam step
+train_arg.add_argument('--steps_per_run', type=int, default=1) # optimizer steps per sess.run
+train_arg.add_argument('--num_thread', type=int, default=0) # intra-op threads, 0: all cores
+# synchronous data-parallel training, empty worker_hosts: single process
+train_arg.add_argument('--job_name', type=str, default='worker',
+                       choices=['ps','worker'])
+train_arg.add_argument('--task_index', type=int, default=0)
+train_arg.add_argument('--ps_hosts', type=str, default='localhost:2222') # host:port,...
+train_arg.add_argument('--worker_hosts', type=str, default='') # host:port,...
 
 # vectorize
 vect_arg = add_argument_group('Vectorize')
@@ -65,13 +90,26 @@ vect_arg.add_argument('--neighbor_sample', type=float, default=1)
 vect_arg.add_argument('--find_overlap', type=str2bool, default=True)
 vect_arg.add_argument('--overlap_threshold', type=float, default=0.5)
 vect_arg.add_argument('--test_batch_size', type=int, default=512)
+vect_arg.add_argument('--delta_inference', type=str2bool, default=False) # pathnet only around each marked pixel
+vect_arg.add_argument('--affinity_dtype', type=str, default='float32',
+                      choices=['float32','float16'])
+vect_arg.add_argument('--pred_format', type=str, default='binary',
+                      choices=['binary','text']) # graphcut input, text for debugging
 vect_arg.add_argument('--mp', type=str2bool, default=True)
 
 # Misc
 misc_arg = add_argument_group('Misc')
 misc_arg.add_argument('--log_step', type=int, default=100)
 misc_arg.add_argument('--test_step', type=int, default=10000) # 1000
+misc_arg.add_argument('--num_eval', type=int, default=4000) # -1: entire test set
+misc_arg.add_argument('--eval_batch_size', type=int, default=256)
+misc_arg.add_argument('--async_eval', type=str2bool, default=False) # evaluate in another process
+misc_arg.add_argument('--eval_dir', type=str, default='') # set for the evaluation process
+misc_arg.add_argument('--eval_sec', type=int, default=30) # checkpoint polling interval
+misc_arg.add_argument('--eval_timeout', type=int, default=600) # wait for the evaluator after training
 misc_arg.add_argument('--save_sec', type=int, default=900)
+misc_arg.add_argument('--async_save', type=str2bool, default=False) # write checkpoints in background
+misc_arg.add_argument('--max_to_keep', type=int, default=5) # checkpoints kept
 misc_arg.add_argument('--log_dir', type=str, default='log')
 misc_arg.add_argument('--tag', type=str, default='test')
 misc_arg.add_argument('--random_seed', type=int, default=123)
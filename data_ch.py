@@ -1,6 +1,7 @@
 import os
 from glob import glob
 import threading
+from functools import partial
 import multiprocessing
 import signal
 import sys
@@ -16,6 +17,11 @@ import xml.etree.ElementTree as et
 import matplotlib.pyplot as plt
 
 from ops import *
+from data_store import load_store, load_test_set, sample_path, sample_paths, sample_overlap, \
+    sample_joint, test_set_path, stack, expand, sample_shapes, SAMPLE_DTYPES
+from render import render_paths
+from augment import augment_params
+from producer import ProcessProducer, Warmup, SampleCounter, load_snapshot, worker_rng
 
 
 class BatchManager(object):
@@ -31,60 +37,183 @@ class BatchManager(object):
         self.height = config.height
         self.width = config.width
 
-        self.is_pathnet = (config.archi == 'path')
-        if self.is_pathnet:
-            feature_dim = [self.height, self.width, 2]
-            label_dim = [self.height, self.width, 1]
-        else:
-            feature_dim = [self.height, self.width, 1]
-            label_dim = [self.height, self.width, 1]
-
-        self.capacity = 10000
-        self.q = tf.FIFOQueue(self.capacity, [tf.float32, tf.float32], [feature_dim, label_dim])
-        self.x = tf.placeholder(dtype=tf.float32, shape=feature_dim)
-        self.y = tf.placeholder(dtype=tf.float32, shape=label_dim)
-        self.enqueue = self.q.enqueue([self.x, self.y])
+        # joint: PathNet and OverlapNet samples from the same renders
+        self.archi = config.archi
+        self.is_joint = (config.archi == 'joint')
+        self.is_pathnet = (config.archi == 'path' or self.is_joint)
+        # compact uint8 samples, expanded to float in the graph
+        self.shapes = sample_shapes(self.height, self.width, self.is_joint)
+
+        # passed on explicitly, worker processes may not share module state
+        self.renderer = config.renderer
+        self.aug = augment_params(config)
+        self.store, self.test_store = None, None
+        if config.use_store:
+            store_dir = os.path.join(self.root, 'store_%dx%d' % (self.width, self.height))
+            render = partial(render_svg, renderer=self.renderer)
+            self.store = load_store(self.paths, render, self.width, self.height,
+                                    os.path.join(store_dir, 'train'), config.num_worker, self.aug,
+                                    renderer=self.renderer)
+            self.test_store = load_store(self.test_paths, render, self.width, self.height,
+                                         os.path.join(store_dir, 'test'), config.num_worker,
+                                         renderer=self.renderer)
+
+        self.capacity = config.capacity
         self.num_threads = config.num_worker
         # np.amin([config.num_worker, multiprocessing.cpu_count(), self.batch_size])
 
+        self.input_pipeline = config.input_pipeline
+        self.producer = config.producer
+        self.random_seed = config.random_seed
+        # PathNet samples per render, sharing its rasters
+        self.num_query = config.num_query if self.is_pathnet else 1
+        # start training once warmup_batches are ready (-1: 80% of capacity)
+        if config.warmup_batches < 0:
+            self.warmup_size = int(self.capacity*0.8)
+        else:
+            self.warmup_size = min(config.warmup_batches*self.batch_size, self.capacity)
+        # queries of one drawing arrive together, mix them up in a shuffle
+        # buffer, no larger than the warmup so a fast start stays fast
+        self.min_after_dequeue = max(min(self.capacity // 4, self.warmup_size,
+                                         self.capacity - self.batch_size), 0)
+        # samples produced by each worker, one counter for the dataset pipeline
+        self.counter = SampleCounter(1 if self.input_pipeline == 'dataset' else self.num_threads)
+        if self.input_pipeline == 'dataset':
+            self.q = None
+            self.dataset = self.build_dataset()
+            self.iterator = None
+        else:
+            dtypes = [tf.as_dtype(dtype) for dtype in SAMPLE_DTYPES[:len(self.shapes)]]
+            if self.num_query > 1:
+                self.q = tf.RandomShuffleQueue(self.capacity, self.min_after_dequeue,
+                                               dtypes, self.shapes, seed=self.random_seed)
+            else:
+                self.q = tf.FIFOQueue(self.capacity, dtypes, self.shapes)
+            self.inputs_many = [tf.placeholder(dtype=dtype, shape=[None] + shape)
+                                for dtype, shape in zip(dtypes, self.shapes)]
+            self.enqueue_many = self.q.enqueue_many(self.inputs_many)
+            self.close = self.q.close(cancel_pending_enqueues=True)
+
+        self.snapshot_path = None
+        if config.use_snapshot:
+            self.snapshot_path = os.path.join(self.root, 'snapshot_%s_%dx%d.npz' % (
+                config.archi, self.width, self.height))
+
+        # test samples with fixed query pixels, rendered once and cached
+        self.num_eval = len(self.test_paths)
+        if config.num_eval >= 0:
+            self.num_eval = min(config.num_eval, self.num_eval)
+        self.test_data = None
+        self.test_thread = None
+
     def __del__(self):
         try:
             self.stop_thread()
         except AttributeError:
             pass
 
+    def build_dataset(self):
+        def load(n, id):
+            # parallel calls run in any order, so seed per sample
+            rng = worker_rng(self.random_seed, n)
+            if self.store is not None:
+                samples = self.store.sample_batch(id, self.archi, rng, self.num_query)
+            else:
+                samples = preprocess_batch(self.paths[id], self.width, self.height,
+                                           rng, self.archi, self.num_query, self.renderer, self.aug)
+            self.counter.add(0, len(samples[0]))
+            return [np.asarray(c, dtype=dtype) for c, dtype in zip(samples, SAMPLE_DTYPES)]
+
+        def load_op(n, id):
+            samples = tf.py_func(load, [n, id], [tf.as_dtype(dtype)
+                                                 for dtype in SAMPLE_DTYPES[:len(self.shapes)]])
+            for c, shape in zip(samples, self.shapes):
+                c.set_shape([None] + shape)
+            return tuple(samples)
+
+        # parallel map over shuffled file ids
+        num_paths = len(self.paths)
+        dataset = tf.data.Dataset.range(num_paths)
+        dataset = dataset.shuffle(num_paths, seed=self.random_seed).repeat()
+        dataset = tf.data.Dataset.zip((tf.data.Dataset.range(np.iinfo(np.int64).max), dataset))
+        dataset = dataset.map(load_op, num_parallel_calls=self.num_threads)
+        dataset = dataset.flat_map(lambda *samples: tf.data.Dataset.from_tensor_slices(samples))
+        if self.num_query > 1:
+            dataset = dataset.shuffle(max(self.min_after_dequeue, 1), seed=self.random_seed)
+        dataset = dataset.batch(self.batch_size)
+        dataset = dataset.prefetch(max(self.capacity // self.batch_size // 10, 1))
+        return dataset.map(lambda *sample: self.expand_batch(list(sample)))
+
     def start_thread(self, sess):
-        print('%s: start to enque with %d threads' % (datetime.now(), self.num_threads))
+        if self.input_pipeline == 'dataset':
+            # samples are produced inside the graph
+            self.sess = sess
+            return
+
+        print('%s: start to enque with %d %ss' % (datetime.now(), self.num_threads, self.producer))
 
         # Main thread: create a coordinator.
         self.sess = sess
         self.coord = tf.train.Coordinator()
 
         # Create a method for loading and enqueuing
-        def load_n_enqueue(sess, enqueue, coord, paths, rng,
-                           x, y, w, h, is_pathnet):
+        def load_n_enqueue(sess, enqueue_many, coord, warmup, counter, worker_id,
+                           paths, store, rng, inputs_many, w, h, archi, num_query, renderer, aug):
             with coord.stop_on_exception():                
                 while not coord.should_stop():
                     id = rng.randint(len(paths))
-                    if is_pathnet:
-                        x_, y_ = preprocess_path(paths[id], w, h, rng)
+                    if store is not None:
+                        samples = store.sample_batch(id, archi, rng, num_query)
                     else:
-                        x_, y_ = preprocess_overlap(paths[id], w, h, rng)
-                    sess.run(enqueue, feed_dict={x: x_, y: y_})
+                        samples = preprocess_batch(paths[id], w, h, rng, archi, num_query,
+                                                   renderer, aug)
+                    sess.run(enqueue_many, feed_dict=dict(zip(inputs_many, samples)))
+                    warmup.add(samples)
+                    counter.add(worker_id, len(samples[0]))
+
+        # prefill from the snapshot of a previous run
+        snapshot = None
+        if self.snapshot_path is not None:
+            snapshot = load_snapshot(self.snapshot_path, self.shapes)
+        self.warmup = Warmup(self.warmup_size, keep=(self.snapshot_path is not None and snapshot is None))
+        if snapshot is not None:
+            snapshot = [c[:self.capacity] for c in snapshot]
+            self.sess.run(self.enqueue_many, feed_dict=dict(zip(self.inputs_many, snapshot)))
+            self.warmup.add(snapshot)
+            print('%s: %d samples restored from %s' % (datetime.now(), len(snapshot[0]), self.snapshot_path))
 
         # Create threads that enqueue
-        self.threads = [threading.Thread(target=load_n_enqueue, 
-                                          args=(self.sess, 
-                                                self.enqueue,
-                                                self.coord,
-                                                self.paths,
-                                                self.rng,
-                                                self.x,
-                                                self.y,
-                                                self.width,
-                                                self.height,
-                                                self.is_pathnet)
-                                          ) for i in range(self.num_threads)]
+        if self.producer == 'process':
+            store_dir = self.store.store_dir if self.store is not None else None
+            self.procs = ProcessProducer(self.num_threads,
+                                         max(self.batch_size, 16) * self.num_threads,
+                                         self.shapes, SAMPLE_DTYPES,
+                                         self.random_seed, self.paths, store_dir,
+                                         preprocess_batch, self.width, self.height,
+                                         self.archi, self.num_query, self.renderer, self.aug)
+            self.threads = self.procs.start(self.sess, self.enqueue_many,
+                                            self.inputs_many, self.coord,
+                                            self.batch_size, self.warmup,
+                                            self.counter)
+        else:
+            self.threads = [threading.Thread(target=load_n_enqueue, 
+                                              args=(self.sess, 
+                                                    self.enqueue_many,
+                                                    self.coord,
+                                                    self.warmup,
+                                                    self.counter,
+                                                    i,
+                                                    self.paths,
+                                                    self.store,
+                                                    worker_rng(self.random_seed, i),
+                                                    self.inputs_many,
+                                                    self.width,
+                                                    self.height,
+                                                    self.archi,
+                                                    self.num_query,
+                                                    self.renderer,
+                                                    self.aug)
+                                              ) for i in range(self.num_threads)]
 
         # define signal handler
         def signal_handler(signum, frame):
@@ -92,8 +221,10 @@ class BatchManager(object):
             #saver.save(sess, "./checkpoints/VDSR_norm_clip_epoch_%03d.ckpt" % epoch ,global_step=global_step)
             print('%s: canceled by SIGINT' % datetime.now())
             self.coord.request_stop()
-            self.sess.run(self.q.close(cancel_pending_enqueues=True))
+            self.sess.run(self.close)
             self.coord.join(self.threads)
+            if self.producer == 'process':
+                self.procs.stop()
             sys.exit(1)
         signal.signal(signal.SIGINT, signal_handler)
 
@@ -101,117 +232,134 @@ class BatchManager(object):
         for t in self.threads:
             t.start()
 
-        # dirty way to bypass graph finilization error
-        g = tf.get_default_graph()
-        g._finalized = False
-        qs = 0
-        while qs < (self.capacity*0.8):
-            qs = self.sess.run(self.q.size())
+        # block until warmup samples are enqueued
+        qs = self.warmup.wait(self.coord)
         print('%s: q size %d' % (datetime.now(), qs))
+        if self.snapshot_path is not None:
+            self.warmup.save(self.snapshot_path)
 
     def stop_thread(self):
-        # dirty way to bypass graph finilization error
-        g = tf.get_default_graph()
-        g._finalized = False
+        if self.input_pipeline == 'dataset':
+            return
 
         self.coord.request_stop()
-        self.sess.run(self.q.close(cancel_pending_enqueues=True))
+        self.sess.run(self.close)
         self.coord.join(self.threads)
-
-    def test_batch(self):
-        x_list, y_list = [], []
-        for i, file_path in enumerate(self.test_paths):
-            if self.is_pathnet:
-                x_, y_ = preprocess_path(file_path, self.width, self.height, self.rng)
-            else:
-                x_, y_ = preprocess_overlap(file_path, self.width, self.height, self.rng)
-            x_list.append(x_)
-            y_list.append(y_)
-            if i % self.batch_size == self.batch_size-1:
-                yield np.array(x_list), np.array(y_list)
-                x_list, y_list = [], []
+        if self.producer == 'process':
+            self.procs.stop()
+
+    def load_test_set(self):
+        if self.test_data is None:
+            test_data = {}
+            for archi in (['path', 'overlap'] if self.is_joint else [self.archi]):
+                is_pathnet = (archi == 'path')
+                sample = partial(preprocess_path if is_pathnet else preprocess_overlap,
+                                 renderer=self.renderer)
+                test_data[archi] = load_test_set(self.test_paths[:self.num_eval], sample,
+                                                 self.width, self.height, is_pathnet,
+                                                 self.random_seed,
+                                                 test_set_path(self.root, archi, self.renderer,
+                                                               self.width, self.height,
+                                                               self.random_seed),
+                                                 self.test_store, self.num_threads)
+            self.test_data = test_data
+        return self.test_data
+
+    def prefetch_test_set(self):
+        # render in the background, the first evaluation waits for it
+        self.test_thread = threading.Thread(target=self.load_test_set)
+        self.test_thread.start()
+
+    def test_set(self, archi=None):
+        if self.test_thread is not None:
+            self.test_thread.join()
+            self.test_thread = None
+        return self.load_test_set()[archi or self.archi]
+
+    def expand_batch(self, sample):
+        # x, y or, joint, PathNet x, y and OverlapNet x, y
+        x, y = expand_sample(*(sample[:4] + [self.is_pathnet]))
+        if not self.is_joint:
+            return x, y
+        xo, yo = expand_overlap(sample[0], sample[4], sample[2], sample[3])
+        return x, y, xo, yo
 
     def batch(self):
-        return self.q.dequeue_many(self.batch_size)
+        if self.input_pipeline == 'dataset':
+            # one iterator, batch() may be called again for in-graph training loops
+            if self.iterator is None:
+                self.iterator = self.dataset.make_one_shot_iterator()
+            batch = self.iterator.get_next()
+            # joint: OverlapNet takes a varying part of the batch
+            for t in batch[:2]:
+                t.set_shape([self.batch_size] + int_shape(t)[1:])
+            return batch
+        sample = self.q.dequeue_many(self.batch_size)
+        return self.expand_batch(sample)
 
     def sample(self, num):
         idx = self.rng.choice(len(self.paths), num).tolist()
         return [self.paths[i] for i in idx]
 
     def random_list(self, num):
-        x_list = []
-        xs, ys = [], []
+        sample_list = []
         file_list = self.sample(num)
         for file_path in file_list:
             if self.is_pathnet:
-                x, y = preprocess_path(file_path, self.width, self.height, self.rng)
+                sample = preprocess_path(file_path, self.width, self.height, self.rng,
+                                         renderer=self.renderer, aug=self.aug)
             else:
-                x, y = preprocess_overlap(file_path, self.width, self.height, self.rng)
-            x_list.append(x)
+                sample = preprocess_overlap(file_path, self.width, self.height, self.rng,
+                                            renderer=self.renderer, aug=self.aug)
+            sample_list.append(sample)
+        x_list, y_list = expand(*(stack(sample_list)[:4] + [self.is_pathnet]))
 
-            if self.is_pathnet:
-                b_ch = np.zeros([self.height,self.width,1])
-                xs.append(np.concatenate((x*255, b_ch), axis=-1))
-            else:
-                xs.append(x*255)
-            ys.append(y*255)
+        if self.is_pathnet:
+            b_ch = np.zeros([num,self.height,self.width,1])
+            xs = np.concatenate((x_list*255, b_ch), axis=-1)
+        else:
+            xs = x_list*255
+        ys = y_list*255
             
-        return np.array(x_list), np.array(xs), np.array(ys), file_list
+        return x_list, xs, ys, file_list
 
     def read_svg(self, file_path):
-        with open(file_path, 'r') as f:
-            svg = f.read()
-
-        r = 0
-        s = [1, -1]
-        t = [0, -900]
-        # if transform:
-        #     r = rng.randint(-45, 45)
-        #     # s_sign = rng.choice([1, -1], 1)[0]
-        #     s_sign = -1
-        #     s = 1.75 * rng.random_sample(2) + 0.25 # [0.25, 2)
-        #     s[1] = s[1] * s_sign
-        #     t = rng.randint(-100, 100, 2)
-        #     if s_sign == 1:
-        #         t[1] = t[1] + 124
-        #     else:
-        #         t[1] = t[1] - 900
-
-        svg = svg.format(w=self.width, h=self.height, r=r, sx=s[0], sy=s[1], tx=t[0], ty=t[1])
-        img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
-        img = Image.open(io.BytesIO(img))
-        s = np.array(img)[:,:,3].astype(np.float) # / 255.0
+        s, paths = render_svg(file_path, self.width, self.height, self.renderer)
+        s = s.astype(np.float32) # / 255.0
         max_intensity = np.amax(s)
         s = s / max_intensity
 
-        path_list = []        
-        svg_xml = et.fromstring(svg)
-
-        sys_name = platform.system()
-        if sys_name == 'Windows':
-            num_paths = len(svg_xml[0]._children)
-        else:
-            num_paths = len(svg_xml[0])
+        path_list = list(paths > 0)
+        return s, len(path_list), path_list
 
-        for i in range(num_paths):
-            svg_xml = et.fromstring(svg)
+def render_svg(file_path, w, h, renderer='cairo'):
+    with open(file_path, 'r') as f:
+        svg = f.read()
 
-            if sys_name == 'Windows':
-                svg_xml[0]._children = [svg_xml[0]._children[i]]
-            else:
-                svg_xml[0][0] = svg_xml[0][i]
-                del svg_xml[0][1:]
-            svg_one = et.tostring(svg_xml, method='xml')
+    r = 0
+    s = [1, -1]
+    t = [0, -900]
+    # if transform:
+    #     r = rng.randint(-45, 45)
+    #     # s_sign = rng.choice([1, -1], 1)[0]
+    #     s_sign = -1
+    #     s = 1.75 * rng.random_sample(2) + 0.25 # [0.25, 2)
+    #     s[1] = s[1] * s_sign
+    #     t = rng.randint(-100, 100, 2)
+    #     if s_sign == 1:
+    #         t[1] = t[1] + 124
+    #     else:
+    #         t[1] = t[1] - 900
 
-            # leave only one path
-            y_png = cairosvg.svg2png(bytestring=svg_one)
-            y_img = Image.open(io.BytesIO(y_png))
-            path = (np.array(y_img)[:,:,3] > 0)            
-            path_list.append(path)
+    svg = svg.format(w=w, h=h, r=r, sx=s[0], sy=s[1], tx=t[0], ty=t[1])
+    return render_paths(svg, 'path', renderer)
 
-        return s, num_paths, path_list
+def preprocess_path(file_path, w, h, rng, train=True, renderer='cairo', aug=None):
+    if renderer == 'numpy':
+        # all paths come out of one rasterization anyway
+        s, paths = render_svg(file_path, w, h, renderer)
+        return sample_path(s, paths, rng, train, aug)
 
-def preprocess_path(file_path, w, h, rng):
     with open(file_path, 'r') as f:
         svg = f.read()
 
@@ -233,9 +381,7 @@ def preprocess_path(file_path, w, h, rng):
     svg = svg.format(w=w, h=h, r=r, sx=s[0], sy=s[1], tx=t[0], ty=t[1])
     img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
     img = Image.open(io.BytesIO(img))
-    s = np.array(img)[:,:,3].astype(np.float) # / 255.0
-    max_intensity = np.amax(s)
-    s = s / max_intensity
+    s = np.array(img)[:,:,3]
 
     # while True:
     svg_xml = et.fromstring(svg)
@@ -253,22 +399,7 @@ def preprocess_path(file_path, w, h, rng):
     # leave only one path
     y_png = cairosvg.svg2png(bytestring=svg_one)
     y_img = Image.open(io.BytesIO(y_png))
-    y = np.array(y_img)[:,:,3].astype(np.float) / max_intensity # [0,1]
-
-    pixel_ids = np.nonzero(y)
-    # if len(pixel_ids[0]) == 0:
-    #     continue
-    # else:
-    #     break            
-
-    # select arbitrary marking pixel
-    point_id = rng.randint(len(pixel_ids[0]))
-    px, py = pixel_ids[0][point_id], pixel_ids[1][point_id]
-
-    y = np.reshape(y, [h, w, 1])
-    x = np.zeros([h, w, 2])
-    x[:,:,0] = s
-    x[px,py,1] = 1.0
+    y = np.array(y_img)[:,:,3]
 
     # # debug
     # plt.figure()
@@ -282,68 +413,10 @@ def preprocess_path(file_path, w, h, rng):
     # plt.imshow(y[:,:,0], cmap=plt.cm.gray)
     # plt.show()
 
-    return x, y
+    return sample_path(s, y[np.newaxis], rng, train, aug)
 
-def preprocess_overlap(file_path, w, h, rng):
-    with open(file_path, 'r') as f:
-        svg = f.read()
-    
-    r = 0
-    s = [1, -1]
-    t = [0, -900]
-    # if transform:
-    #     r = rng.randint(-45, 45)
-    #     # s_sign = rng.choice([1, -1], 1)[0]
-    #     s_sign = -1
-    #     s = 1.75 * rng.random_sample(2) + 0.25 # [0.25, 2)
-    #     s[1] = s[1] * s_sign
-    #     t = rng.randint(-100, 100, 2)
-    #     if s_sign == 1:
-    #         t[1] = t[1] + 124
-    #     else:
-    #         t[1] = t[1] - 900
-
-    svg = svg.format(w=w, h=h, r=r, sx=s[0], sy=s[1], tx=t[0], ty=t[1])
-    img = cairosvg.svg2png(bytestring=svg.encode('utf-8'))
-    img = Image.open(io.BytesIO(img))
-    s = np.array(img)[:,:,3].astype(np.float) # / 255.0
-    max_intensity = np.amax(s)
-    s = s / max_intensity
-
-    # while True:
-    path_list = []        
-    svg_xml = et.fromstring(svg)
-
-    sys_name = platform.system()
-    if sys_name == 'Windows':
-        num_paths = len(svg_xml[0]._children)
-    else:
-        num_paths = len(svg_xml[0])
-
-    for i in range(num_paths):
-        svg_xml = et.fromstring(svg)
-
-        if sys_name == 'Windows':
-            svg_xml[0]._children = [svg_xml[0]._children[i]]
-        else:
-            svg_xml[0][0] = svg_xml[0][i]
-            del svg_xml[0][1:]
-        svg_one = et.tostring(svg_xml, method='xml')
-
-        # leave only one path
-        y_png = cairosvg.svg2png(bytestring=svg_one)
-        y_img = Image.open(io.BytesIO(y_png))
-        path = (np.array(y_img)[:,:,3] > 0)            
-        path_list.append(path)
-
-    y = np.zeros([h, w], dtype=np.int)
-    for i in range(num_paths-1):
-        for j in range(i+1, num_paths):
-            intersect = np.logical_and(path_list[i], path_list[j])
-            y = np.logical_or(intersect, y)
-
-    x = np.expand_dims(s, axis=-1)
-    y = np.expand_dims(y, axis=-1)
+def preprocess_overlap(file_path, w, h, rng, train=True, renderer='cairo', aug=None):
+    s, paths = render_svg(file_path, w, h, renderer)
 
     # # debug
     # plt.figure()
@@ -355,7 +428,24 @@ def preprocess_overlap(file_path, w, h, rng):
     # plt.imshow(y[:,:,0], cmap=plt.cm.gray)
     # plt.show()
 
-    return x, y
+    return sample_overlap(s, paths, rng, train, aug)
+
+def preprocess_batch(file_path, w, h, rng, archi, num_query=1, renderer='cairo',
+                     aug=None):
+    # samples of one render, batched: num_query PathNet samples (joint: with
+    # the OverlapNet label) or one OverlapNet sample
+    if archi == 'joint':
+        s, paths = render_svg(file_path, w, h, renderer)
+        return sample_joint(s, paths, rng, num_query, aug=aug)
+    if archi == 'path' and num_query > 1:
+        s, paths = render_svg(file_path, w, h, renderer)
+        return sample_paths(s, paths, rng, num_query, aug=aug)
+
+    if archi == 'path':
+        sample = preprocess_path(file_path, w, h, rng, renderer=renderer, aug=aug)
+    else:
+        sample = preprocess_overlap(file_path, w, h, rng, renderer=renderer, aug=aug)
+    return [np.asarray(c)[np.newaxis] for c in sample]
 
 def main(config):
     prepare_dirs_and_logger(config)
@@ -0,0 +1,314 @@
+import os
+import json
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+from augment import augment
+
+
+# pre-rasterized sample store
+#
+# store_dir/
+#   meta.json   number of drawings, size, renderer, file list (written last)
+#   img.u8      [num, h, w] uint8 alpha of the full drawing
+#   mask.u8     [num_masks, h, w] uint8 alpha of each path, drawing by drawing
+#   offset.npy  [num+1] int64, masks of drawing i are mask[offset[i]:offset[i+1]]
+
+class SampleStore(object):
+    def __init__(self, store_dir, aug=None):
+        self.store_dir = store_dir
+        self.aug = aug # training samples only
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        self.num = meta['num']
+        self.height = meta['height']
+        self.width = meta['width']
+        self.num_masks = meta['num_masks']
+
+        self.img = np.memmap(os.path.join(store_dir, 'img.u8'), dtype=np.uint8,
+                             mode='r', shape=(self.num, self.height, self.width))
+        if self.num_masks > 0:
+            self.mask = np.memmap(os.path.join(store_dir, 'mask.u8'), dtype=np.uint8,
+                                  mode='r', shape=(self.num_masks, self.height, self.width))
+        else:
+            self.mask = np.zeros([0, self.height, self.width], dtype=np.uint8)
+        self.offset = np.load(os.path.join(store_dir, 'offset.npy'))
+
+    def __len__(self):
+        return self.num
+
+    def read(self, i):
+        return self.img[i], self.mask[self.offset[i]:self.offset[i+1]]
+
+    def sample(self, i, is_pathnet, rng, train=True):
+        if is_pathnet:
+            return self.sample_path(i, rng, train)
+        else:
+            return self.sample_overlap(i, rng, train)
+
+    def sample_path(self, i, rng, train=True):
+        s, masks = self.read(i)
+        return sample_path(s, masks, rng, train, self.aug)
+
+    def sample_overlap(self, i, rng, train=True):
+        s, masks = self.read(i)
+        return sample_overlap(s, masks, rng, train, self.aug)
+
+    def sample_batch(self, i, archi, rng, num_query=1):
+        if archi == 'joint':
+            s, masks = self.read(i)
+            return sample_joint(s, masks, rng, num_query, aug=self.aug)
+        if archi == 'path' and num_query > 1:
+            s, masks = self.read(i)
+            return sample_paths(s, masks, rng, num_query, aug=self.aug)
+        return [np.asarray(c)[np.newaxis] for c in self.sample(i, archi == 'path', rng)]
+
+
+# compact samples
+#
+# a sample is (s, y, scale, point): the uint8 alpha of the drawing [h, w],
+# the uint8 label [h, w] (alpha of the selected path for PathNet, 0/1
+# overlap for OverlapNet), the float32 max intensity both are normalized by
+# and the int32 marked pixel [2] (-1: none). expand() in numpy or
+# ops.expand_sample() in the graph turn it into float32 [0,1] x and y.
+# joint samples add the uint8 0/1 overlap label [h, w] of the drawing,
+# flagged with OVERLAP_COPY in all but the first sample of a render so that
+# OverlapNet batches take it once (ops.expand_overlap).
+# training samples are augmented on the rasters with aug, see augment.py
+
+SAMPLE_KEYS = ['s', 'y', 'scale', 'point', 'overlap']
+SAMPLE_DTYPES = [np.uint8, np.uint8, np.float32, np.int32, np.uint8]
+OVERLAP_COPY = 2
+
+def sample_shapes(h, w, is_joint=False):
+    if is_joint:
+        return [[h, w], [h, w], [], [2], [h, w]]
+    return [[h, w], [h, w], [], [2]]
+
+def blank(h, w):
+    return (np.zeros([h, w], dtype=np.uint8), np.zeros([h, w], dtype=np.uint8),
+            np.float32(1), np.array([-1, -1], dtype=np.int32))
+
+def sample_path(s, masks, rng, train=True, aug=None):
+    """PathNet sample from the uint8 alpha of a drawing and its path stack."""
+    if train:
+        s, masks = augment(s, masks, rng, aug)
+    h, w = s.shape
+
+    # select among paths that cover at least one pixel
+    max_intensity = np.amax(s)
+    path_ids = np.nonzero(np.amax(masks.reshape([len(masks), -1]), axis=1))[0]
+    if max_intensity == 0 or len(path_ids) == 0:
+        return blank(h, w)
+
+    path_id = path_ids[rng.randint(len(path_ids))]
+    y = masks[path_id]
+    pixel_ids = np.nonzero(y)
+
+    # select arbitrary marking pixel
+    point_id = rng.randint(len(pixel_ids[0]))
+    point = np.array([pixel_ids[0][point_id], pixel_ids[1][point_id]], dtype=np.int32)
+    return s, y, np.float32(max_intensity), point
+
+def sample_paths(s, masks, rng, num, train=True, aug=None):
+    """num PathNet samples sharing the rasters of one drawing, batched."""
+    if train:
+        s, masks = augment(s, masks, rng, aug)
+    h, w = s.shape
+
+    max_intensity = np.amax(s)
+    path_ids = np.nonzero(np.amax(masks.reshape([len(masks), -1]), axis=1))[0]
+    if max_intensity == 0 or len(path_ids) == 0:
+        return stack([blank(h, w)] * num)
+
+    # a path for each query, then a marking pixel on it
+    y = masks[path_ids[rng.randint(len(path_ids), size=num)]]
+    point = np.zeros([num, 2], dtype=np.int32)
+    for i in range(num):
+        pixel_ids = np.nonzero(y[i])
+        point_id = rng.randint(len(pixel_ids[0]))
+        point[i] = pixel_ids[0][point_id], pixel_ids[1][point_id]
+
+    s = np.repeat(s[np.newaxis], num, axis=0)
+    scale = np.full(num, max_intensity, dtype=np.float32)
+    return [s, y, scale, point]
+
+def sample_overlap(s, masks, rng, train=True, aug=None):
+    """OverlapNet sample from the uint8 alpha of a drawing and its path stack."""
+    if train:
+        s, masks = augment(s, masks, rng, aug)
+    h, w = s.shape
+
+    max_intensity = np.amax(s)
+    if max_intensity == 0:
+        return blank(h, w)
+
+    # pixels covered by two or more paths
+    y = (np.sum(masks > 0, axis=0) >= 2).astype(np.uint8)
+    return s, y, np.float32(max_intensity), np.array([-1, -1], dtype=np.int32)
+
+def sample_joint(s, masks, rng, num=1, train=True, aug=None):
+    """num PathNet samples of one drawing, batched, each with its
+    OverlapNet label, flagged as a copy after the first."""
+    if train:
+        s, masks = augment(s, masks, rng, aug)
+    h, w = s.shape
+
+    samples = sample_paths(s, masks, rng, num, train=False)
+    if np.amax(s) == 0:
+        overlap = np.zeros([h, w], dtype=np.uint8)
+    else:
+        overlap = (np.sum(masks > 0, axis=0) >= 2).astype(np.uint8)
+    overlap = np.repeat(overlap[np.newaxis], num, axis=0)
+    overlap[1:] += OVERLAP_COPY
+    return samples + [overlap]
+
+def stack(samples):
+    # list of samples -> batch of samples
+    return [np.array(c) for c in zip(*samples)]
+
+def expand(s, y, scale, point, is_pathnet):
+    """Float32 x [n, h, w, 2 or 1] and y [n, h, w, 1] from a batch of samples."""
+    scale = np.reshape(scale, [-1, 1, 1, 1]).astype(np.float32)
+    x = s[...,np.newaxis].astype(np.float32) / scale
+    y = y[...,np.newaxis].astype(np.float32)
+    if not is_pathnet:
+        return x, y
+
+    marked = np.zeros_like(x)
+    i = np.nonzero(point[:,0] >= 0)[0]
+    marked[i, point[i,0], point[i,1], 0] = 1.0
+    return np.concatenate((x, marked), axis=-1), y / scale
+
+
+def _render(args):
+    render, file_path, w, h = args
+    return render(file_path, w, h)
+
+def compile_store(paths, render, w, h, store_dir, num_worker=1, renderer='cairo'):
+    """Render each drawing once into store_dir. render(file_path, w, h)
+    returns the uint8 alpha of the drawing and a [num_paths, h, w] uint8
+    stack with the alpha of each path, renderer names the backend it uses."""
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    num = len(paths)
+    print('%s: compile %d drawings into %s' % (datetime.now(), num, store_dir))
+    img = np.memmap(os.path.join(store_dir, 'img.u8'), dtype=np.uint8,
+                    mode='w+', shape=(num, h, w))
+    offset = np.zeros(num+1, dtype=np.int64)
+
+    pool = multiprocessing.Pool(max(num_worker, 1))
+    jobs = [(render, file_path, w, h) for file_path in paths]
+    with open(os.path.join(store_dir, 'mask.u8'), 'wb') as f:
+        for i, (s, masks) in enumerate(pool.imap(_render, jobs, chunksize=16)):
+            img[i] = s
+            f.write(masks.astype(np.uint8).tobytes())
+            offset[i+1] = offset[i] + len(masks)
+            if i % 1000 == 999:
+                print('%s: compiled %d/%d' % (datetime.now(), i+1, num))
+    pool.close()
+    pool.join()
+
+    img.flush()
+    del img
+    np.save(os.path.join(store_dir, 'offset.npy'), offset)
+
+    # meta goes last so that an interrupted compile is never loaded
+    meta = {
+        'num': num,
+        'height': h,
+        'width': w,
+        'renderer': renderer,
+        'num_masks': int(offset[-1]),
+        'paths': [os.path.basename(p) for p in paths],
+    }
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+def load_store(paths, render, w, h, store_dir, num_worker=1, aug=None, renderer='cairo'):
+    # compile on first use or when the renderer or the file list has changed
+    meta_path = os.path.join(store_dir, 'meta.json')
+    is_valid = False
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        is_valid = (meta['height'] == h and meta['width'] == w and
+                    meta.get('renderer') == renderer and
+                    meta['paths'] == [os.path.basename(p) for p in paths])
+
+    if not is_valid:
+        compile_store(paths, render, w, h, store_dir, num_worker, renderer)
+
+    store = SampleStore(store_dir, aug)
+    print('%s: store loaded from %s (%d drawings, %d paths)' % (
+        datetime.now(), store_dir, store.num, store.num_masks))
+    return store
+
+
+# test samples with fixed query pixels, kept compact and expanded
+# batch by batch
+
+def _test_sample(args):
+    sample, file_path, w, h, seed, i = args
+    return sample(file_path, w, h, np.random.RandomState([seed, i]), train=False)
+
+class TestSet(object):
+    def __init__(self, s, y, scale, point, is_pathnet):
+        self.s = s
+        self.y = y
+        self.scale = scale
+        self.point = point
+        self.is_pathnet = is_pathnet
+
+    def __len__(self):
+        return len(self.s)
+
+    def batch(self, start, end):
+        return expand(self.s[start:end], self.y[start:end], self.scale[start:end],
+                      self.point[start:end], self.is_pathnet)
+
+    def batches(self, batch_size):
+        for start in range(0, len(self), batch_size):
+            yield self.batch(start, min(start+batch_size, len(self)))
+
+    def save(self, path):
+        np.savez(path, **dict(zip(SAMPLE_KEYS, [self.s, self.y, self.scale, self.point])))
+
+def test_set_path(root, archi, renderer, w, h, seed):
+    return os.path.join(root, 'test_%s_%s_%dx%d_%d.npz' % (archi, renderer, w, h, seed))
+
+def load_test_set(paths, sample, w, h, is_pathnet, seed, cache_path,
+                  store=None, num_worker=1):
+    """Render the test set once, query pixels drawn from (seed, index),
+    and cache it next to the dataset. sample must be picklable."""
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if len(cache['s']) == len(paths) and list(cache['s'].shape[1:]) == [h, w]:
+            print('%s: test set loaded from %s' % (datetime.now(), cache_path))
+            return TestSet(cache['s'], cache['y'], cache['scale'], cache['point'], is_pathnet)
+
+    print('%s: render %d test samples' % (datetime.now(), len(paths)))
+    if store is not None:
+        samples = [store.sample(i, is_pathnet, np.random.RandomState([seed, i]), train=False)
+                   for i in range(len(paths))]
+    else:
+        # may run next to the session and enqueue threads (prefetch_test_set),
+        # forking a multithreaded process can deadlock, so workers are spawned
+        pool = multiprocessing.get_context('spawn').Pool(max(num_worker, 1))
+        jobs = [(sample, file_path, w, h, seed, i) for i, file_path in enumerate(paths)]
+        samples = pool.map(_test_sample, jobs, chunksize=16)
+        pool.close()
+        pool.join()
+
+    test_set = TestSet(*(stack(samples) + [is_pathnet]))
+    test_set.save(cache_path)
+    print('%s: test set saved to %s' % (datetime.now(), cache_path))
+    return test_set
@@ -0,0 +1,101 @@
+from __future__ import print_function
+
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from models import *
+from trainer import evaluate, DONE_FILE
+
+class Evaluator(object):
+    """Evaluates the checkpoints a running Trainer writes to model_dir on the
+    cached test set, and adds the loss/test_acc_* summaries to its event
+    directory, so training never waits for evaluation."""
+    def __init__(self, config, batch_manager):
+        self.config = config
+        self.batch_manager = batch_manager
+        self.model_dir = config.model_dir
+        self.max_step = config.max_step
+        self.eval_sec = config.eval_sec
+        self.eval_batch_size = config.eval_batch_size
+        self.data_format = config.data_format
+
+        # (test set, scope, summary prefix)
+        if config.archi == 'joint':
+            nets = [('path', 'PathNet', 'loss/test_acc_'),
+                    ('overlap', 'OverlapNet', 'loss/test_acc_overlap_')]
+        else:
+            nets = [(config.archi, 'VDSR', 'loss/test_acc_')]
+
+        self.nets = []
+        summary = []
+        for archi, scope, prefix in nets:
+            x_ch = 2 if archi == 'path' else 1
+            xt = tf.placeholder(tf.float32, shape=[None, config.height, config.width, x_ch])
+            yt = tf.placeholder(tf.float32, shape=[None, config.height, config.width, 1])
+            if self.data_format == 'NCHW':
+                xt = nhwc_to_nchw(xt)
+                yt = nhwc_to_nchw(yt)
+
+            yt_, _ = VDSR(
+                    xt, config.conv_hidden_num, config.repeat_num, self.data_format,
+                    config.use_norm, name=scope, train=False)
+            yt_ = tf.clip_by_value(yt_, 0, 1)
+            metrics = test_metrics(yt_, yt, name='test_metrics_' + archi)
+
+            acc = [tf.placeholder(tf.float32) for _ in range(3)]
+            summary += [tf.summary.scalar(prefix + name, a)
+                        for name, a in zip(['l1', 'l2', 'iou'], acc)]
+            self.nets.append((archi, xt, yt, metrics, acc))
+
+        self.summary_test = tf.summary.merge(summary)
+        self.summary_writer = tf.summary.FileWriter(self.model_dir)
+        self.saver = tf.train.Saver(tf.global_variables())
+
+        gpu_options = tf.GPUOptions(allow_growth=True)
+        sess_config = tf.ConfigProto(allow_soft_placement=True,
+                                     gpu_options=gpu_options)
+        self.sess = tf.Session(config=sess_config)
+
+    def evaluate(self, ckpt_path, step):
+        self.saver.restore(self.sess, ckpt_path)
+
+        feed_dict = {}
+        for archi, xt, yt, metrics, acc in self.nets:
+            result = evaluate(self.sess, self.batch_manager.test_set(archi), xt, yt, metrics,
+                              self.eval_batch_size, self.data_format)
+            feed_dict.update(zip(acc, result))
+            print('%s: [%d] %s l1 %.4f l2 %.4f iou %.4f' % ((datetime.now(), step, archi) + result))
+
+        summary_test = self.sess.run(self.summary_test, feed_dict)
+        self.summary_writer.add_summary(summary_test, step)
+        self.summary_writer.flush()
+
+    def run(self):
+        # stop after the last checkpoint: the trainer is done or gone
+        ppid = os.getppid()
+        done_path = os.path.join(self.model_dir, DONE_FILE)
+        last_path = None
+        while True:
+            # checked first, the last checkpoint is saved before the marker
+            is_done = os.path.exists(done_path) or os.getppid() != ppid
+            ckpt_path = tf.train.latest_checkpoint(self.model_dir)
+            if ckpt_path is None or ckpt_path == last_path:
+                if is_done:
+                    break
+                time.sleep(self.eval_sec)
+                continue
+
+            step = int(ckpt_path.split('-')[-1])
+            try:
+                self.evaluate(ckpt_path, step)
+            except tf.errors.NotFoundError:
+                # removed by the saver in between
+                pass
+            last_path = ckpt_path
+            if step >= self.max_step:
+                break
+
+        self.summary_writer.close()
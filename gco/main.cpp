@@ -6,6 +6,8 @@
 #include <iostream>
 #include <fstream>
 #include <string>
+#include <vector>
+#include <cstring>
 #include "GCoptimization.h"
 
 float smoothFn(int p1, int p2, int l1, int l2, void *data)
@@ -23,26 +25,83 @@ float smoothFn(int p1, int p2, int l1, int l2, void *data)
 	return pred_distance;
 }
 
+// binary pred file written by tester.write_pred, little-endian
+//   header: magic[8], int32 version, n_labels, label_cost,
+//           float32 neighbor_sigma, prediction_sigma, int32 n_sites, int64 n_edges
+//   edges:  n_edges x (int32 i, int32 j, float32 pred, float32 spatial)
+static const char PRED_MAGIC[8] = {'V', 'N', 'P', 'R', 'E', 'D', '\0', '\0'};
+static const int PRED_VERSION = 1;
+
+struct Edge {
+	int i, j;
+	float pred, spatial;
+};
+
 int main(int argc, char **argv)
 {
+	if (argc < 2) {
+		std::cout << "Usage: gco pred_file_path" << std::endl;
+		return -1;
+	}
+	// lets the tester check that this build reads binary pred files
+	if (strcmp(argv[1], "--pred_version") == 0) {
+		std::cout << PRED_VERSION << std::endl;
+		return 0;
+	}
+
 	//std::cout << argv[1] << std::endl;
-	std::ifstream is(argv[1]);
+	std::ifstream is(argv[1], std::ios::binary);
 
 	if (!is.is_open()) {
 		std::cout << "Unable to open pred file" << std::endl;
 		return -1;
 	}
 	
+	char magic[8];
+	is.read(magic, sizeof(magic));
+	bool is_binary = is.gcount() == sizeof(magic) && memcmp(magic, PRED_MAGIC, sizeof(magic)) == 0;
+
 	std::string pred_file_path, data_dir;
 	int n_labels, n_sites, label_cost;
 	float neighbor_sigma, prediction_sigma;
-	is >> pred_file_path;
-	is >> data_dir;
-	is >> n_labels;
-	is >> label_cost;
-	is >> neighbor_sigma;
-	is >> prediction_sigma;
-	is >> n_sites;
+	std::vector<Edge> edges;
+	if (is_binary) {
+		int version;
+		long long n_edges;
+		is.read((char*)&version, sizeof(version));
+		if (version != PRED_VERSION) {
+			std::cout << "Unsupported pred file version " << version << std::endl;
+			return -1;
+		}
+		is.read((char*)&n_labels, sizeof(n_labels));
+		is.read((char*)&label_cost, sizeof(label_cost));
+		is.read((char*)&neighbor_sigma, sizeof(neighbor_sigma));
+		is.read((char*)&prediction_sigma, sizeof(prediction_sigma));
+		is.read((char*)&n_sites, sizeof(n_sites));
+		is.read((char*)&n_edges, sizeof(n_edges));
+
+		// all edges in one read
+		edges.resize(n_edges);
+		if (n_edges > 0) {
+			is.read((char*)&edges[0], n_edges * sizeof(Edge));
+		}
+		if (!is) {
+			std::cout << "Truncated pred file" << std::endl;
+			return -1;
+		}
+	}
+	else {
+		// text format, kept for debugging
+		is.close();
+		is.open(argv[1]);
+		is >> pred_file_path;
+		is >> data_dir;
+		is >> n_labels;
+		is >> label_cost;
+		is >> neighbor_sigma;
+		is >> prediction_sigma;
+		is >> n_sites;
+	}
 
 	//std::cout << "pred_file_path:" << pred_file_path << std::endl;
 	//std::cout << "data_dir:" << data_dir << std::endl;
@@ -61,13 +120,22 @@ int main(int argc, char **argv)
 		w[i] = new float[n_sites]();
 	}
 
-	while (is.good()) {
-		int i, j;
-		float p, spatial;		
-		is >> i >> j >> p >> spatial;
-		//std::cout << i << " " << j << " " << p << " " << spatial << std::endl;
-		pred[i][j] = p;
-		w[i][j] = spatial;
+	if (is_binary) {
+		for (size_t k = 0; k < edges.size(); ++k) {
+			pred[edges[k].i][edges[k].j] = edges[k].pred;
+			w[edges[k].i][edges[k].j] = edges[k].spatial;
+		}
+		std::vector<Edge>().swap(edges);
+	}
+	else {
+		while (is.good()) {
+			int i, j;
+			float p, spatial;		
+			is >> i >> j >> p >> spatial;
+			//std::cout << i << " " << j << " " << p << " " << spatial << std::endl;
+			pred[i][j] = p;
+			w[i][j] = spatial;
+		}
 	}
 
 	// std::cout << "0 1 " << pred[0][1] << " " << w[0][1] << std::endl;
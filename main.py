@@ -5,7 +5,41 @@ from config import get_config
 from utils import prepare_dirs_and_logger, save_config
 
 def main(config):
+    if config.worker_hosts:
+        from trainer import cluster_spec
+        cluster = cluster_spec(config)
+        if config.job_name == 'ps':
+            server = tf.train.Server(cluster, job_name='ps', task_index=config.task_index)
+            server.join()
+            return
+
+        # variables on ps, everything else (sample queue included) on this worker
+        device = tf.train.replica_device_setter(
+            worker_device='/job:worker/task:%d' % config.task_index, cluster=cluster)
+        # own sample stream per worker
+        config.random_seed += config.task_index
+    else:
+        device = None
+
     prepare_dirs_and_logger(config)
+
+    if config.eval_dir:
+        from evaluator import Evaluator
+        if config.dataset == 'line':
+            from data_line import BatchManager
+        elif config.dataset == 'ch':
+            from data_ch import BatchManager
+        elif config.dataset == 'kanji':
+            from data_kanji import BatchManager
+        elif config.dataset == 'baseball' or\
+             config.dataset == 'cat':
+            from data_qdraw import BatchManager
+
+        batch_manager = BatchManager(config)
+        evaluator = Evaluator(config, batch_manager)
+        evaluator.run()
+        return
+
     save_config(config)
 
     if config.is_train:
@@ -20,8 +54,9 @@ def main(config):
              config.dataset == 'cat':
             from data_qdraw import BatchManager
 
-        batch_manager = BatchManager(config)
-        trainer = Trainer(config, batch_manager)
+        with tf.device(device):
+            batch_manager = BatchManager(config)
+            trainer = Trainer(config, batch_manager)
         trainer.train()
     else:
         from tester import Tester
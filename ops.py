@@ -6,6 +6,8 @@ import tensorflow as tf
 import tensorflow.contrib.slim as slim
 import numpy as np
 
+from data_store import OVERLAP_COPY
+
 def lrelu(x, leak=0.2):
     return tf.maximum(x, leak*x)
    
@@ -116,6 +118,89 @@ def to_nhwc_numpy(image):
         new_image = image
     return new_image
 
+def expand_sample(s, y, scale, point, is_pathnet):
+    # float [0,1] NHWC x and y from a batch of compact uint8 samples,
+    # see data_store.py
+    _, h, w = int_shape(s)
+    scale = tf.reshape(scale, [-1, 1, 1, 1])
+    x = tf.expand_dims(tf.cast(s, tf.float32), -1) / scale
+    y = tf.expand_dims(tf.cast(y, tf.float32), -1)
+    if not is_pathnet:
+        return x, y
+
+    return tf.concat([x, marked_channel(point, h, w)], axis=-1), y / scale
+
+def expand_overlap(s, overlap, scale, point):
+    # OverlapNet x and y from joint samples, once per render: samples flagged
+    # with OVERLAP_COPY are dropped, unless the batch has nothing else
+    overlap = tf.cast(overlap, tf.int32)
+    keep = tf.less(overlap[:,0,0], OVERLAP_COPY)
+    first = tf.equal(tf.range(tf.shape(keep)[0]), 0)
+    keep = tf.logical_or(keep, tf.logical_and(first, tf.logical_not(tf.reduce_any(keep))))
+    s, overlap, scale, point = [tf.boolean_mask(c, keep) for c in [s, overlap, scale, point]]
+    return expand_sample(s, tf.floormod(overlap, OVERLAP_COPY), scale, point, False)
+
+def marked_channel(point, h, w):
+    # one-hot marked pixel [n, h, w, 1], -1 (none) gives an empty channel
+    marked = tf.one_hot(point[:,0]*w + point[:,1], h*w, dtype=tf.float32)
+    return tf.reshape(marked, [-1, h, w, 1])
+
+def pathnet_inputs(img, point, origin=None, size=None):
+    """NHWC PathNet x [n, h, w, 2] from a float image [h, w] fed once and
+    the marked pixels [n, 2], or from the patches of size [2] at origin [n, 2]."""
+    if origin is None:
+        h, w = int_shape(img)
+        x = tf.tile(tf.reshape(img, [1, h, w, 1]), tf.stack([tf.shape(point)[0], 1, 1, 1]))
+        return tf.concat([x, marked_channel(point, h, w)], axis=-1)
+
+    # gather each patch with a [n, ph, pw, 2] index grid
+    ph, pw = size
+    rows = tf.tile(tf.expand_dims(origin[:,0:1] + tf.range(ph), 2), [1, 1, pw])
+    cols = tf.tile(tf.expand_dims(origin[:,1:2] + tf.range(pw), 1), [1, ph, 1])
+    x = tf.expand_dims(tf.gather_nd(img, tf.stack([rows, cols], axis=-1)), -1)
+    return tf.concat([x, marked_channel(point - origin, ph, pw)], axis=-1)
+
+def test_metrics(y_, y, name='test_metrics'):
+    """Streaming l1, l2 accuracy and iou over test batches, accumulated in
+    local variables. Returns the update and reset ops and the results,
+    so evaluation only fetches scalars."""
+    with tf.variable_scope(name):
+        def accumulator(name):
+            return tf.Variable(0.0, name=name, trainable=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        sum_l1, sum_l2, sum_iou = accumulator('l1'), accumulator('l2'), accumulator('iou')
+        num, num_iou = accumulator('num'), accumulator('num_iou')
+
+        # per sample, iou only where the union is nonzero
+        axis = [1, 2, 3]
+        l1 = 1 - tf.reduce_mean(tf.abs(y_ - y), axis)
+        l2 = 1 - tf.reduce_mean(tf.squared_difference(y_, y), axis)
+        i = tf.reduce_sum(tf.to_float(tf.logical_and(y > 0, y_ > 0)), axis)
+        u = tf.reduce_sum(tf.to_float(tf.logical_or(y > 0, y_ > 0)), axis)
+        nonzero = tf.to_float(u > 0)
+
+        update = tf.group(tf.assign_add(sum_l1, tf.reduce_sum(l1)),
+                          tf.assign_add(sum_l2, tf.reduce_sum(l2)),
+                          tf.assign_add(sum_iou, tf.reduce_sum(i / tf.maximum(u, 1))),
+                          tf.assign_add(num, tf.to_float(tf.shape(y)[0])),
+                          tf.assign_add(num_iou, tf.reduce_sum(nonzero)))
+        reset = tf.variables_initializer([sum_l1, sum_l2, sum_iou, num, num_iou])
+        result = [sum_l1 / num, sum_l2 / num,
+                  tf.where(num_iou > 0, sum_iou / tf.maximum(num_iou, 1), 1.0)]
+    return update, reset, result
+
+def gather_pixels(y, point, data_format='NHWC'):
+    """Values [b, n] of the single channel maps y at pixels point,
+    [n, 2] for every map or [b, n, 2] for each map."""
+    _, h, w, _ = get_conv_shape(y, data_format)
+    y = tf.reshape(y, [-1, h*w])
+    b = tf.shape(y)[0]
+    if len(point.get_shape()) == 2:
+        point = tf.tile(tf.expand_dims(point, 0), tf.stack([b, 1, 1]))
+    n = tf.shape(point)[1]
+    batch = tf.tile(tf.expand_dims(tf.range(b), 1), tf.stack([1, n]))
+    return tf.gather_nd(y, tf.stack([batch, point[...,0]*w + point[...,1]], axis=-1))
+
 def add_channels(x, num_ch=1, data_format='NHWC'):
     b, h, w, c = get_conv_shape(x, data_format)
     if data_format == 'NCHW':
@@ -0,0 +1,186 @@
+import os
+import time
+import threading
+import multiprocessing
+import signal
+import queue
+from datetime import datetime
+
+import numpy as np
+
+from data_store import SampleStore, SAMPLE_KEYS
+
+
+def worker_rng(seed, worker_id):
+    # independent stream per worker, reproducible from (seed, worker_id)
+    return np.random.RandomState([seed, worker_id])
+
+# spawn, not fork: the trainer process already runs TF and the prefetch
+# threads by the time the producers start
+mp = multiprocessing.get_context('spawn')
+
+def shared_array(shape, dtype):
+    buf = mp.RawArray(np.ctypeslib.as_ctypes_type(dtype), int(np.prod(shape)))
+    return buf, np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+def produce(worker_id, seed, paths, store_dir, preprocess_batch, w, h, archi,
+            num_query, renderer, aug, bufs, shapes, dtypes, free_q, full_q):
+    # SIGINT is handled by the trainer, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    rings = [np.frombuffer(buf, dtype=dtype).reshape(shape)
+             for buf, shape, dtype in zip(bufs, shapes, dtypes)]
+    rng = worker_rng(seed, worker_id)
+    store = SampleStore(store_dir, aug) if store_dir else None
+
+    while True:
+        id = rng.randint(len(paths))
+        if store is not None:
+            samples = store.sample_batch(id, archi, rng, num_query)
+        else:
+            samples = preprocess_batch(paths[id], w, h, rng, archi, num_query, renderer, aug)
+
+        for k in range(len(samples[0])):
+            slot = free_q.get()
+            if slot is None:
+                return
+            for ring, c in zip(rings, samples):
+                ring[slot] = c[k]
+            full_q.put((slot, worker_id))
+
+
+class Warmup(object):
+    """Counts enqueued samples so that start_thread can block until the
+    first ones are ready, optionally keeping them for a queue snapshot."""
+    def __init__(self, target, keep=False):
+        self.target = target
+        self.keep = keep
+        self.count = 0
+        self.sample_list = []
+        self.cond = threading.Condition()
+
+    def add(self, samples):
+        # samples: batched components of compact samples
+        with self.cond:
+            if self.keep and self.count < self.target:
+                self.sample_list.append([np.array(c) for c in samples])
+            self.count += len(samples[0])
+            if self.count >= self.target:
+                self.cond.notify_all()
+
+    def wait(self, coord):
+        with self.cond:
+            while self.count < self.target and not coord.should_stop():
+                self.cond.wait(1)
+            self.keep = False
+        return self.count
+
+    def save(self, path):
+        if len(self.sample_list) == 0:
+            return
+        samples = [np.concatenate(c) for c in zip(*self.sample_list)]
+        np.savez(path, **dict(zip(SAMPLE_KEYS, samples)))
+        print('%s: snapshot of %d samples saved to %s' % (
+            datetime.now(), len(samples[0]), path))
+        self.sample_list = []
+
+class SampleCounter(object):
+    """Counts the samples of each producer worker for samples/sec."""
+    def __init__(self, num_worker):
+        self.num_worker = num_worker
+        self.count = np.zeros(num_worker, dtype=np.int64)
+        self.last_count = np.zeros(num_worker, dtype=np.int64)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, worker_id, n):
+        with self.lock:
+            self.count[worker_id] += n
+
+    def rates(self):
+        # samples/sec of each worker since the last call
+        with self.lock:
+            count = self.count.copy()
+        now = time.time()
+        rates = (count - self.last_count) / max(now - self.last_time, 1e-6)
+        self.last_count, self.last_time = count, now
+        return rates
+
+def load_snapshot(path, shapes):
+    if not os.path.exists(path):
+        return None
+    snapshot = np.load(path)
+    keys = SAMPLE_KEYS[:len(shapes)]
+    if (any(k not in snapshot.files for k in keys) or
+        any(list(snapshot[k].shape[1:]) != list(shape) for k, shape in zip(keys, shapes))):
+        print('%s: snapshot %s does not match, ignored' % (datetime.now(), path))
+        return None
+    return [snapshot[k] for k in keys]
+
+
+class ProcessProducer(object):
+    """Worker processes render samples into a shared-memory ring buffer,
+    a thread in the trainer process drains it into the sample queue.
+    Slot indices travel through free_q / full_q, samples never get pickled."""
+    def __init__(self, num_worker, num_slot, shapes, dtypes, seed,
+                 paths, store_dir, preprocess_batch, w, h, archi, num_query, renderer, aug):
+        self.num_worker = num_worker
+        self.num_slot = num_slot
+        self.shapes = [[num_slot] + list(shape) for shape in shapes]
+        self.dtypes = dtypes
+        self.bufs, self.rings = zip(*[shared_array(shape, dtype)
+                                      for shape, dtype in zip(self.shapes, dtypes)])
+
+        self.free_q = mp.Queue()
+        self.full_q = mp.Queue()
+        for slot in range(num_slot):
+            self.free_q.put(slot)
+
+        self.procs = [mp.Process(target=produce,
+                                 args=(i, seed, paths, store_dir,
+                                       preprocess_batch,
+                                       w, h, archi, num_query, renderer, aug,
+                                       self.bufs, self.shapes,
+                                       self.dtypes,
+                                       self.free_q, self.full_q))
+                      for i in range(num_worker)]
+        for p in self.procs:
+            p.daemon = True
+
+    def start(self, sess, enqueue_many, inputs, coord, batch_size, warmup, counter):
+        print('%s: start %d producer processes (%d slots)' % (
+            datetime.now(), self.num_worker, self.num_slot))
+        for p in self.procs:
+            p.start()
+
+        def drain():
+            with coord.stop_on_exception():
+                while not coord.should_stop():
+                    try:
+                        items = [self.full_q.get(timeout=1)]
+                    except queue.Empty:
+                        continue
+                    while len(items) < batch_size:
+                        try:
+                            items.append(self.full_q.get_nowait())
+                        except queue.Empty:
+                            break
+
+                    slots = [slot for slot, _ in items]
+                    for _, worker_id in items:
+                        counter.add(worker_id, 1)
+                    samples = [ring[slots] for ring in self.rings]
+                    for slot in slots:
+                        self.free_q.put(slot)
+                    sess.run(enqueue_many, feed_dict=dict(zip(inputs, samples)))
+                    warmup.add(samples)
+
+        return [threading.Thread(target=drain)]
+
+    def stop(self):
+        for _ in self.procs:
+            self.free_q.put(None)
+        for p in self.procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
@@ -0,0 +1,447 @@
+import re
+import xml.etree.ElementTree as et
+
+import numpy as np
+
+
+# native rasterizer for the svg subset used by the datasets:
+# <path> (M L H V C S Q T A Z, absolute and relative), <polyline>, <polygon>
+# and <line> in nested <g> with transforms, fill and stroke styles.
+# strokes are antialiased with their signed distance at pixel centers,
+# fills with nonzero winding on a supersampled grid.
+
+NUM_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+PATH_RE = re.compile(r'[MmLlHhVvCcSsQqTtAaZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+TRANSFORM_RE = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+INHERITED = ['fill', 'stroke', 'stroke-width', 'stroke-linecap', 'stroke-linejoin']
+SUPERSAMPLE = 4
+
+
+def _tag(element):
+    return element.tag.split('}')[-1]
+
+def _style(element, parent):
+    style = dict((k, parent[k]) for k in INHERITED)
+    for k in INHERITED:
+        if k in element.attrib:
+            style[k] = element.attrib[k].strip()
+    for item in element.attrib.get('style', '').split(';'):
+        if ':' in item:
+            k, v = item.split(':', 1)
+            if k.strip() in INHERITED:
+                style[k.strip()] = v.strip()
+    style['display'] = element.attrib.get('display', 'inline')
+    return style
+
+def _length(value):
+    return float(NUM_RE.match(value.strip()).group())
+
+def _matrix(a, b, c, d, e, f):
+    return np.array([[a, c, e], [b, d, f], [0, 0, 1]], dtype=np.float64)
+
+def _transform(value):
+    m = np.eye(3)
+    for name, args in TRANSFORM_RE.findall(value):
+        v = [float(n) for n in NUM_RE.findall(args)]
+        if name == 'matrix':
+            t = _matrix(*v)
+        elif name == 'translate':
+            t = _matrix(1, 0, 0, 1, v[0], v[1] if len(v) > 1 else 0)
+        elif name == 'scale':
+            t = _matrix(v[0], 0, 0, v[1] if len(v) > 1 else v[0], 0, 0)
+        elif name == 'rotate':
+            r = np.deg2rad(v[0])
+            t = _matrix(np.cos(r), np.sin(r), -np.sin(r), np.cos(r), 0, 0)
+            if len(v) > 2:
+                t = np.dot(np.dot(_matrix(1, 0, 0, 1, v[1], v[2]), t),
+                           _matrix(1, 0, 0, 1, -v[1], -v[2]))
+        elif name == 'skewX':
+            t = _matrix(1, 0, np.tan(np.deg2rad(v[0])), 1, 0, 0)
+        else:
+            t = _matrix(1, np.tan(np.deg2rad(v[0])), 0, 1, 0, 0)
+        m = np.dot(m, t)
+    return m
+
+def _viewport(root):
+    w = int(round(_length(root.attrib['width'])))
+    h = int(round(_length(root.attrib['height'])))
+    m = np.eye(3)
+    if 'viewBox' in root.attrib:
+        # preserveAspectRatio="xMidYMid meet"
+        bx, by, bw, bh = [float(n) for n in NUM_RE.findall(root.attrib['viewBox'])]
+        scale = min(w / bw, h / bh)
+        tx = (w - bw*scale) / 2 - bx*scale
+        ty = (h - bh*scale) / 2 - by*scale
+        m = _matrix(scale, 0, 0, scale, tx, ty)
+    return w, h, m
+
+def _bezier(p, n):
+    # p: [4, 2] cubic control points, n segments
+    t = np.linspace(0, 1, n+1)[1:, np.newaxis]
+    s = 1 - t
+    return s**3*p[0] + 3*s**2*t*p[1] + 3*s*t**2*p[2] + t**3*p[3]
+
+def _arc(p0, rx, ry, angle, large_arc, sweep, p1):
+    """Elliptical arc from p0 to p1 as cubic segments of at most 90 degrees,
+    converted from the endpoint to the center parameterization (SVG F.6.5)."""
+    if np.all(p0 == p1):
+        return []
+    rx, ry = abs(rx), abs(ry)
+    if rx == 0 or ry == 0:
+        return [('L', p1)]
+    phi = np.deg2rad(angle)
+    r = np.array([[np.cos(phi), -np.sin(phi)], [np.sin(phi), np.cos(phi)]])
+
+    x1, y1 = np.dot(r.T, (p0 - p1) / 2)
+    # scale up radii too small to reach p1
+    scale = x1**2 / rx**2 + y1**2 / ry**2
+    if scale > 1:
+        rx, ry = rx*np.sqrt(scale), ry*np.sqrt(scale)
+    num = rx**2*ry**2 - rx**2*y1**2 - ry**2*x1**2
+    coef = np.sqrt(max(num, 0) / (rx**2*y1**2 + ry**2*x1**2))
+    if large_arc == sweep:
+        coef = -coef
+    cx, cy = coef*rx*y1/ry, -coef*ry*x1/rx
+    center = np.dot(r, [cx, cy]) + (p0 + p1) / 2
+
+    theta = np.arctan2((y1 - cy)/ry, (x1 - cx)/rx)
+    delta = np.arctan2((-y1 - cy)/ry, (-x1 - cx)/rx) - theta
+    if sweep and delta < 0:
+        delta += 2*np.pi
+    elif not sweep and delta > 0:
+        delta -= 2*np.pi
+
+    # unit circle cubics mapped by rotation and radii
+    m = np.dot(r, np.diag([rx, ry]))
+    n = int(np.ceil(abs(delta) / (np.pi/2) - 1e-9))
+    d = delta / n
+    k = 4.0/3.0 * np.tan(d/4)
+    segments = []
+    for j in range(n):
+        t0, t1 = theta + j*d, theta + (j+1)*d
+        e0 = np.array([np.cos(t0), np.sin(t0)])
+        e1 = np.array([np.cos(t1), np.sin(t1)])
+        c = np.array([e0, e0 + k*np.array([-e0[1], e0[0]]),
+                      e1 - k*np.array([-e1[1], e1[0]]), e1])
+        c = np.dot(c, m.T) + center
+        c[0] = p0 if j == 0 else segments[-1][1][3]
+        if j == n-1:
+            c[3] = p1
+        segments.append(('C', c))
+    return segments
+
+def _subpaths(d):
+    """Parse path data into a list of (segments, closed) in user space,
+    where a segment is ('L', end point) or ('C', [4, 2] control points)."""
+    tokens = PATH_RE.findall(d)
+    subpaths = []
+    points = []
+    cur = np.zeros(2)
+    start = np.zeros(2)
+    prev_c, prev_q = None, None # for smooth curves
+    cmd = None
+    i = 0
+
+    def nums(k):
+        return np.array([float(tokens[i+j]) for j in range(k)])
+
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            cmd = tokens[i]
+            i += 1
+            if cmd in 'Zz':
+                if len(points) > 0:
+                    subpaths.append((points, True))
+                points = []
+                cur = start.copy()
+                prev_c, prev_q = None, None
+                continue
+
+        c = cmd.upper()
+        origin = cur if cmd.islower() else np.zeros(2)
+        next_c, next_q = None, None
+        if c == 'M':
+            if len(points) > 0:
+                subpaths.append((points, False))
+            cur = origin + nums(2)
+            i += 2
+            start = cur.copy()
+            points = [('L', cur)]
+            # following pairs are implicit lineto
+            cmd = 'l' if cmd.islower() else 'L'
+        elif c == 'L':
+            cur = origin + nums(2)
+            i += 2
+            points.append(('L', cur))
+        elif c == 'H':
+            v = nums(1)[0]
+            i += 1
+            cur = np.array([origin[0] + v, cur[1]])
+            points.append(('L', cur))
+        elif c == 'V':
+            v = nums(1)[0]
+            i += 1
+            cur = np.array([cur[0], origin[1] + v])
+            points.append(('L', cur))
+        elif c == 'C' or c == 'S':
+            if c == 'C':
+                v = nums(6)
+                i += 6
+                c1, c2, end = origin + v[0:2], origin + v[2:4], origin + v[4:6]
+            else:
+                v = nums(4)
+                i += 4
+                c1 = cur if prev_c is None else 2*cur - prev_c
+                c2, end = origin + v[0:2], origin + v[2:4]
+            points.append(('C', np.array([cur, c1, c2, end])))
+            next_c = c2
+            cur = end
+        elif c == 'Q' or c == 'T':
+            if c == 'Q':
+                v = nums(4)
+                i += 4
+                q, end = origin + v[0:2], origin + v[2:4]
+            else:
+                v = nums(2)
+                i += 2
+                q = cur if prev_q is None else 2*cur - prev_q
+                end = origin + v
+            # elevate quadratic to cubic
+            c1 = cur + 2.0/3.0*(q - cur)
+            c2 = end + 2.0/3.0*(q - end)
+            points.append(('C', np.array([cur, c1, c2, end])))
+            next_q = q
+            cur = end
+        elif c == 'A':
+            v = nums(7)
+            i += 7
+            end = origin + v[5:7]
+            points += _arc(cur, v[0], v[1], v[2], v[3] != 0, v[4] != 0, end)
+            cur = end
+        else:
+            raise ValueError('unsupported path command %s' % cmd)
+        prev_c, prev_q = next_c, next_q
+
+    if len(points) > 0:
+        subpaths.append((points, False))
+    return subpaths
+
+def _flatten(subpath, m):
+    # map to device space and flatten curves to ~1px segments
+    points, closed = subpath
+    poly = []
+    for kind, p in points:
+        p = np.dot(np.reshape(p, [-1, 2]), m[:2, :2].T) + m[:2, 2]
+        if kind == 'L':
+            poly.append(p)
+        else:
+            length = np.sum(np.linalg.norm(np.diff(p, axis=0), axis=1))
+            n = int(np.clip(np.ceil(length), 1, 64))
+            poly.append(_bezier(p, n))
+    return np.concatenate(poly, axis=0), closed
+
+def _points(value):
+    v = [float(n) for n in NUM_RE.findall(value)]
+    v = np.reshape(np.array(v[:len(v)//2*2]), [-1, 2])
+    return [('L', p) for p in v]
+
+def _shapes(element, style, m, tag, shapes):
+    """Collect drawable elements as (style, device polylines, scale, is_tag)."""
+    if style['display'] == 'none':
+        return
+    t = _tag(element)
+    if 'transform' in element.attrib:
+        m = np.dot(m, _transform(element.attrib['transform']))
+
+    if t == 'path':
+        subpaths = _subpaths(element.attrib.get('d', ''))
+    elif t == 'polyline' or t == 'polygon':
+        subpaths = [(_points(element.attrib.get('points', '')), t == 'polygon')]
+    elif t == 'line':
+        a = np.array([float(element.attrib.get('x1', 0)), float(element.attrib.get('y1', 0))])
+        b = np.array([float(element.attrib.get('x2', 0)), float(element.attrib.get('y2', 0))])
+        subpaths = [([('L', a), ('L', b)], False)]
+    elif t in ['svg', 'g']:
+        for child in element:
+            _shapes(child, _style(child, style), m, tag, shapes)
+        return
+    else:
+        return
+
+    polys = [_flatten(sp, m) for sp in subpaths if len(sp[0]) > 0]
+    scale = np.sqrt(abs(np.linalg.det(m[:2, :2])))
+    shapes.append((style, polys, scale, t == tag))
+
+def _stroke(polys, hw, cap, h, w):
+    # segments with their caps: round joins at interior vertices
+    a_list, b_list, ca_list, cb_list = [], [], [], []
+    for poly, closed in polys:
+        if closed and len(poly) > 1 and np.any(poly[0] != poly[-1]):
+            poly = np.concatenate([poly, poly[:1]], axis=0)
+        if len(poly) == 1:
+            poly = np.concatenate([poly, poly], axis=0)
+        n = len(poly) - 1
+        a_list.append(poly[:-1])
+        b_list.append(poly[1:])
+        ca = np.full(n, 'round', dtype=object)
+        cb = np.full(n, 'round', dtype=object)
+        if not closed:
+            ca[0] = cap
+            cb[-1] = cap
+        ca_list.append(ca)
+        cb_list.append(cb)
+    if len(a_list) == 0:
+        return np.zeros([h, w])
+    a = np.concatenate(a_list)
+    b = np.concatenate(b_list)
+    ca = np.concatenate(ca_list)
+    cb = np.concatenate(cb_list)
+
+    # pixel centers within the bbox of each segment
+    pad = hw + 1
+    x0 = np.clip(np.floor(np.minimum(a[:,0], b[:,0]) - pad), 0, w).astype(np.int64)
+    x1 = np.clip(np.ceil(np.maximum(a[:,0], b[:,0]) + pad), 0, w).astype(np.int64)
+    y0 = np.clip(np.floor(np.minimum(a[:,1], b[:,1]) - pad), 0, h).astype(np.int64)
+    y1 = np.clip(np.ceil(np.maximum(a[:,1], b[:,1]) + pad), 0, h).astype(np.int64)
+    bw = x1 - x0
+    count = bw * (y1 - y0)
+    seg = np.repeat(np.arange(len(a)), count)
+    if len(seg) == 0:
+        return np.zeros([h, w])
+    local = np.arange(len(seg)) - np.repeat(np.cumsum(count) - count, count)
+    px = x0[seg] + local % bw[seg]
+    py = y0[seg] + local // bw[seg]
+    p = np.stack([px + 0.5, py + 0.5], axis=1)
+
+    # signed distance to the stroked box of each segment
+    d = b - a
+    length = np.linalg.norm(d, axis=1)
+    u_dir = d / np.maximum(length, 1e-12)[:, np.newaxis]
+    ap = p - a[seg]
+    u = np.sum(ap * u_dir[seg], axis=1)
+    v = np.abs(ap[:,0]*u_dir[seg,1] - ap[:,1]*u_dir[seg,0])
+    u0 = np.where(ca == 'square', -hw, 0.0)[seg]
+    u1 = (length + np.where(cb == 'square', hw, 0.0))[seg]
+    du = np.maximum(u0 - u, u - u1)
+    dv = v - hw
+    dist = (np.hypot(np.maximum(du, 0), np.maximum(dv, 0)) +
+            np.minimum(np.maximum(du, dv), 0))
+    # butt caps of zero-length segments draw nothing
+    dist = np.where(length[seg] > 0, dist, np.inf)
+
+    # round caps and joins
+    ra = (ca == 'round')[seg]
+    rb = (cb == 'round')[seg]
+    dist = np.where(ra, np.minimum(dist, np.linalg.norm(ap, axis=1) - hw), dist)
+    dist = np.where(rb, np.minimum(dist, np.linalg.norm(p - b[seg], axis=1) - hw), dist)
+
+    sdf = np.full([h, w], np.inf)
+    np.minimum.at(sdf, (py, px), dist)
+    return np.clip(0.5 - sdf, 0, 1)
+
+def _fill(polys, h, w):
+    # nonzero winding on a supersampled grid, accumulated along scanlines
+    k = SUPERSAMPLE
+    acc = np.zeros([h*k, w*k+1], dtype=np.int32)
+    edges = []
+    for poly, _ in polys:
+        if len(poly) < 2:
+            continue
+        edges.append(np.stack([poly, np.roll(poly, -1, axis=0)], axis=1))
+    if len(edges) == 0:
+        return np.zeros([h, w])
+    e = np.concatenate(edges) * k
+    y_a, y_b = e[:,0,1], e[:,1,1]
+    direction = np.where(y_b > y_a, 1, -1)
+    lo = np.minimum(y_a, y_b)
+    hi = np.maximum(y_a, y_b)
+
+    # sample rows r with lo <= r+0.5 < hi
+    r0 = np.clip(np.ceil(lo - 0.5), 0, h*k).astype(np.int64)
+    r1 = np.clip(np.ceil(hi - 0.5), 0, h*k).astype(np.int64)
+    count = np.maximum(r1 - r0, 0)
+    edge = np.repeat(np.arange(len(e)), count)
+    if len(edge) == 0:
+        return np.zeros([h, w])
+    row = r0[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(count) - count, count)
+    y = row + 0.5
+    xa, ya, xb, yb = e[edge,0,0], e[edge,0,1], e[edge,1,0], e[edge,1,1]
+    x = xa + (y - ya) * (xb - xa) / (yb - ya)
+
+    # winding of sample c counts crossings left of it, x < c+0.5
+    col = np.clip(np.floor(x - 0.5).astype(np.int64) + 1, 0, w*k)
+    np.add.at(acc, (row, col), direction[edge])
+    inside = np.cumsum(acc, axis=1)[:, :w*k] != 0
+    return inside.reshape([h, k, w, k]).mean(axis=(1, 3))
+
+def _coverage(shape, h, w):
+    style, polys, scale, _ = shape
+    alpha = np.zeros([h, w])
+    if style['fill'] != 'none':
+        alpha = _fill(polys, h, w)
+    if style['stroke'] != 'none':
+        hw = _length(style['stroke-width']) * scale / 2
+        stroke = _stroke(polys, hw, style['stroke-linecap'], h, w)
+        alpha = 1 - (1 - alpha) * (1 - stroke)
+    return alpha
+
+def rasterize(svg, tag='path'):
+    """Same as render.render_paths but without cairo: returns the uint8 alpha
+    of the drawing and a [num_paths, h, w] uint8 alpha stack of <tag>s."""
+    root = et.fromstring(svg)
+    w, h, m = _viewport(root)
+    style = {
+        'fill': 'black', 'stroke': 'none', 'stroke-width': '1',
+        'stroke-linecap': 'butt', 'stroke-linejoin': 'miter',
+    }
+    shapes = []
+    _shapes(root, _style(root, style), m, tag, shapes)
+
+    # composite like cairo's OVER operator on alpha
+    s = np.zeros([h, w])
+    path_list = []
+    for shape in shapes:
+        alpha = _coverage(shape, h, w)
+        s = 1 - (1 - s) * (1 - alpha)
+        if shape[3]:
+            path_list.append(alpha)
+
+    s = np.round(s*255).astype(np.uint8)
+    paths = np.round(np.reshape(np.array(path_list), [len(path_list), h, w])*255).astype(np.uint8)
+    return s, paths
+
+
+def check_fidelity(config, num=100):
+    """Compare the native rasterizer to cairosvg on the test set."""
+    if config.dataset == 'line':
+        import data_line as data
+    elif config.dataset == 'ch':
+        import data_ch as data
+    elif config.dataset == 'kanji':
+        import data_kanji as data
+    else:
+        import data_qdraw as data
+
+    file_paths = data.BatchManager(config).test_paths[:num]
+    l1, iou = [], []
+    for file_path in file_paths:
+        s_c, p_c = data.render_svg(file_path, config.width, config.height, 'cairo')
+        s_n, p_n = data.render_svg(file_path, config.width, config.height, 'numpy')
+        assert p_c.shape == p_n.shape, '%s: %s vs %s' % (file_path, p_c.shape, p_n.shape)
+
+        l1.append(np.mean(np.abs(s_c.astype(np.float) - s_n)) / 255.0)
+        for y_c, y_n in zip(p_c > 0, p_n > 0):
+            union = np.sum(np.logical_or(y_c, y_n))
+            if union > 0:
+                iou.append(np.sum(np.logical_and(y_c, y_n)) / float(union))
+
+    print('%s: %d drawings, alpha l1 %.4f, path iou %.4f (min %.4f)' % (
+        config.dataset, len(file_paths), np.average(l1), np.average(iou), np.amin(iou)))
+
+if __name__ == '__main__':
+    from config import get_config
+    from utils import prepare_dirs_and_logger
+
+    config, unparsed = get_config()
+    prepare_dirs_and_logger(config)
+    check_fidelity(config)
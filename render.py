@@ -0,0 +1,57 @@
+import io
+import sys
+
+import numpy as np
+import cairosvg
+
+from raster import rasterize
+
+def _find(node, tag):
+    nodes = []
+    for child in node.children:
+        if child.tag == tag:
+            nodes.append(child)
+        else:
+            nodes += _find(child, tag)
+    return nodes
+
+def _alpha(tree):
+    # draw into a cairo image surface and read its alpha channel,
+    # no png encoding and decoding in between
+    surface = cairosvg.surface.PNGSurface(tree, io.BytesIO(), 96)
+    image = surface.cairo
+    image.flush()
+    h, w, stride = image.get_height(), image.get_width(), image.get_stride()
+    data = np.frombuffer(image.get_data(), dtype=np.uint8).reshape([h, stride])
+
+    # ARGB32 is stored as native-endian 32 bit words
+    a = 3 if sys.byteorder == 'little' else 0
+    return data[:, a:4*w:4].copy()
+
+def render_paths(svg, tag='path', renderer='cairo'):
+    """Parse svg once and render the full drawing plus each <tag> element
+    alone. Returns the uint8 alpha of the drawing and a [num_paths, h, w]
+    uint8 stack with the alpha of each path. renderer: 'cairo' or 'numpy'."""
+    if renderer == 'numpy':
+        return rasterize(svg, tag)
+
+    tree = cairosvg.parser.Tree(bytestring=svg.encode('utf-8'))
+    s = _alpha(tree)
+
+    nodes = _find(tree, tag)
+    display = [node.get('display') for node in nodes]
+    for node in nodes:
+        node['display'] = 'none'
+
+    path_list = []
+    for i, node in enumerate(nodes):
+        # leave only one path
+        if display[i] is None:
+            del node['display']
+        else:
+            node['display'] = display[i]
+        path_list.append(_alpha(tree))
+        node['display'] = 'none'
+
+    h, w = s.shape
+    return s, np.reshape(np.array(path_list, dtype=np.uint8), [len(nodes), h, w])
@@ -6,7 +6,7 @@ import multiprocessing
 import time
 from datetime import datetime
 import platform
-from subprocess import call
+from subprocess import call, check_output, CalledProcessError
 from shutil import copyfile
 
 import numpy as np
@@ -19,7 +19,7 @@ import matplotlib.cm as cmx
 import scipy.misc
 
 from models import *
-from utils import save_image
+from utils import save_image, conv_receptive_field_size
 
 class Param(object):
     pass
@@ -34,6 +34,21 @@ def vectorize_mp(q):
         print('%s: qsize %d' % (datetime.now(), q.qsize()))
         q.task_done()
 
+def restore(sess, load_dir, scope):
+    ckpt = tf.train.get_checkpoint_state(load_dir)
+    assert(ckpt and load_dir)
+    ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
+    ckpt_path = os.path.join(load_dir, ckpt_name)
+
+    # joint checkpoints keep each network under its own scope
+    var_list = tf.global_variables()
+    names = tf.train.NewCheckpointReader(ckpt_path).get_variable_to_shape_map()
+    if not any(name.startswith('VDSR/') for name in names):
+        var_list = dict((scope + v.op.name[len('VDSR'):], v) for v in var_list)
+
+    saver = tf.train.Saver(var_list)
+    saver.restore(sess, ckpt_path)
+
 
 class Tester(object):
     def __init__(self, config, batch_manager):
@@ -49,6 +64,14 @@ class Tester(object):
         self.repeat_num = config.repeat_num
         self.data_format = config.data_format
         self.use_norm = config.use_norm
+        self.delta_inference = config.delta_inference
+        self.affinity_dtype = config.affinity_dtype
+        self.pred_format = config.pred_format
+        if self.pred_format == 'binary' and gco_pred_version() < PRED_VERSION:
+            # a gco built before the binary format would misread it silently
+            print('%s: gco does not read binary pred files, rebuild it with '
+                  'build_linux.sh or build_win.bat, text pred files used' % datetime.now())
+            self.pred_format = 'text'
 
         self.load_pathnet = config.load_pathnet
         self.load_overlapnet = config.load_overlapnet
@@ -81,19 +104,49 @@ class Tester(object):
                                      gpu_options=tf.GPUOptions(allow_growth=True))
         self.sp = tf.Session(config=sess_config, graph=pathnet_graph)
         with pathnet_graph.as_default():
-            self.xp = tf.placeholder(tf.float32, shape=[None, self.height, self.width, 2])
+            # the image once plus the marked pixels, inputs are built in the graph
+            self.img = tf.placeholder(tf.float32, shape=[self.height, self.width])
+            self.query = tf.placeholder(tf.int32, shape=[None, 2])
+            self.xp = pathnet_inputs(self.img, self.query)
             if self.data_format == 'NCHW':
                 self.xp = nhwc_to_nchw(self.xp)
 
             self.yp, _ = VDSR(self.xp, self.conv_hidden_num, self.repeat_num, 
                 self.data_format, self.use_norm, train=False)
+
+            # affinity: each output map read at the path pixels only, [b, n]
+            self.target = tf.placeholder(tf.int32, shape=[None, 2])
+            self.affinity = gather_pixels(tf.clip_by_value(self.yp, 0, 1), self.target,
+                                          self.data_format)
+
+            if self.delta_inference:
+                # the marked pixel reaches rf_radius pixels of the output,
+                # computing those needs the input within 2*rf_radius
+                self.rf_radius = (conv_receptive_field_size(self.repeat_num, 3) - 1) // 2
+                self.patch_size = (min(4*self.rf_radius+1, self.height),
+                                   min(4*self.rf_radius+1, self.width))
+                self.origin = tf.minimum(tf.maximum(self.query - 2*self.rf_radius, 0),
+                                         [self.height - self.patch_size[0],
+                                          self.width - self.patch_size[1]])
+                self.xpp = pathnet_inputs(self.img, self.query, self.origin, self.patch_size)
+                if self.data_format == 'NCHW':
+                    self.xpp = nhwc_to_nchw(self.xpp)
+                self.ypp, _ = VDSR(self.xpp, self.conv_hidden_num, self.repeat_num,
+                    self.data_format, self.use_norm, train=False, reuse=True)
+
+                # path pixels within rf_radius of the marked one come from its
+                # patch, the others from the unmarked output fed as base
+                self.base = tf.placeholder(tf.float32, shape=[None])
+                near = tf.reduce_all(tf.abs(tf.expand_dims(self.target, 0) -
+                                            tf.expand_dims(self.query, 1)) <= self.rf_radius, axis=2)
+                rel = tf.expand_dims(self.target, 0) - tf.expand_dims(self.origin, 1)
+                rel = tf.minimum(tf.maximum(rel, 0), [self.patch_size[0]-1, self.patch_size[1]-1])
+                affinity = gather_pixels(tf.clip_by_value(self.ypp, 0, 1), rel, self.data_format)
+                self.affinity_delta = tf.where(near, affinity,
+                                               tf.zeros_like(affinity) + tf.expand_dims(self.base, 0))
             show_all_variables()
 
-            saver = tf.train.Saver()
-            ckpt = tf.train.get_checkpoint_state(self.load_pathnet)
-            assert(ckpt and self.load_pathnet)
-            ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-            saver.restore(self.sp, os.path.join(self.load_pathnet, ckpt_name))
+            restore(self.sp, self.load_pathnet, 'PathNet')
             print('%s: Pre-trained model restored from %s' % (datetime.now(), self.load_pathnet))
 
         if self.find_overlap:
@@ -108,11 +161,7 @@ class Tester(object):
                     self.data_format, self.use_norm, train=False)
                 show_all_variables()
 
-                saver = tf.train.Saver()
-                ckpt = tf.train.get_checkpoint_state(self.load_overlapnet)
-                assert(ckpt and self.load_overlapnet)
-                ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
-                saver.restore(self.so, os.path.join(self.load_overlapnet, ckpt_name))
+                restore(self.so, self.load_overlapnet, 'OverlapNet')
                 print('%s: Pre-trained model restored from %s' % (datetime.now(), self.load_overlapnet))
 
     def test(self):
@@ -156,11 +205,12 @@ class Tester(object):
 
         # predict paths through pathnet
         start_time = time.time()
-        paths, path_pixels = self.extract_path(img)        
+        affinity, path_pixels = self.extract_path(img)
         num_path_pixels = len(path_pixels[0])
         pids = self.rng.randint(num_path_pixels, size=8)
+        paths = self.run_pathnet(self.yp, img, np.transpose(path_pixels)[pids])
         path_img_path = os.path.join(self.model_dir, '%s_1_path.png' % file_name)
-        save_image((1 - paths[pids,:,:,:])*255, path_img_path, padding=0)
+        save_image((1 - paths)*255, path_img_path, padding=0)
         
         # # debug
         # plt.imshow(paths[0,:,:,0], cmap=plt.cm.gray)
@@ -205,76 +255,47 @@ class Tester(object):
         else:
             pm.duration_ov = 0
 
-        # write config file for graphcut
+        # graphcut edges
         start_time = time.time()
         tmp_dir = os.path.join(self.model_dir, 'tmp')
         if not os.path.exists(tmp_dir):
             os.makedirs(tmp_dir)
         pred_file_path = os.path.join(tmp_dir, file_name+'.pred')
-        f = open(pred_file_path, 'w')
-        # info
-        f.write(pred_file_path + '\n')
-        f.write(self.data_path + '\n')
-        f.write('%d\n' % self.max_label)
-        f.write('%d\n' % self.label_cost)
-        f.write('%f\n' % self.sigma_neighbor)
-        f.write('%f\n' % self.sigma_predict)
-        # f.write('%d\n' % num_path_pixels)
-        f.write('%d\n' % dup_id)
 
         # support only symmetric edge weight
-        radius = self.sigma_neighbor*2
-        nb = sklearn.neighbors.NearestNeighbors(radius=radius)
-        nb.fit(np.array(path_pixels).transpose())
-
-        high_spatial = 100000
-        for i in range(num_path_pixels-1):
-            p1 = np.array([path_pixels[0][i], path_pixels[1][i]])
-            pred_p1 = np.reshape(paths[i,:,:,:], [self.height, self.width])
-
-            # see close neighbors and some far neighbors (stochastic sampling)
-            rng = nb.radius_neighbors([p1])
-            num_close = len(rng[1][0])
-            far = np.setdiff1d(range(i+1,num_path_pixels),rng[1][0])
-            num_far = len(far)
-            num_far = int(num_far * self.neighbor_sample)
-            if num_far > 0:
-                far_ids = self.rng.choice(far, size=num_far)
-                nb_ids = np.concatenate((rng[1][0],far_ids))
-            else:
-                nb_ids = rng[1][0]
-            
-            for rj, j in enumerate(nb_ids): # ids
-                if j <= i:
-                    continue                
-                p2 = np.array([path_pixels[0][j], path_pixels[1][j]])
-                if rj < num_close: d12 = rng[0][0][rj]
-                else: d12 = np.linalg.norm(p1-p2, 2)            
-
-            # for j in range(i+1, num_path_pixels): # see entire neighbors
-            #     p2 = np.array([path_pixels[0][j], path_pixels[1][j]])
-            #     d12 = np.linalg.norm(p1-p2, 2)
-                
-                pred_p2 = np.reshape(paths[j,:,:,:], [self.height, self.width])
-                pred = (pred_p1[p2[0],p2[1]] + pred_p2[p1[0],p1[1]]) * 0.5
-                pred = np.exp(-0.5 * (1.0-pred)**2 / self.sigma_predict**2)
-
-                spatial = np.exp(-0.5 * d12**2 / self.sigma_neighbor**2)
-                f.write('%d %d %f %f\n' % (i, j, pred, spatial))
-
-                dup_i = dup_dict.get(i)
-                if dup_i is not None:
-                    f.write('%d %d %f %f\n' % (j, dup_i, pred, spatial)) # as dup is always smaller than normal id
-                    f.write('%d %d %f %f\n' % (i, dup_i, 0, high_spatial)) # shouldn't be labeled together
-                dup_j = dup_dict.get(j)
-                if dup_j is not None:
-                    f.write('%d %d %f %f\n' % (i, dup_j, pred, spatial)) # as dup is always smaller than normal id
-                    f.write('%d %d %f %f\n' % (j, dup_j, 0, high_spatial)) # shouldn't be labeled together
-
-                if dup_i is not None and dup_j is not None:
-                    f.write('%d %d %f %f\n' % (dup_i, dup_j, pred, spatial)) # dup_i < dup_j
-
-        f.close()
+        # see close neighbors and some far neighbors (stochastic sampling)
+        pair_i, pair_j, d12 = neighbor_pairs(path_pixels, self.sigma_neighbor*2,
+                                             self.neighbor_sample, self.rng)
+
+        # output for i at j and for j at i, summed in float32 even for a float16 affinity
+        pred = (affinity[pair_i,pair_j].astype(np.float32) +
+                affinity[pair_j,pair_i].astype(np.float32)).astype(np.float64) * 0.5
+        pred = np.exp(-0.5 * (1.0-pred)**2 / self.sigma_predict**2)
+        spatial = np.exp(-0.5 * d12**2 / self.sigma_neighbor**2)
+
+        dup = np.full(num_path_pixels, -1, dtype=np.int64)
+        for i, dup_i in dup_dict.items():
+            dup[i] = dup_i
+        edges = graph_edges(pair_i, pair_j, pred, spatial, dup)
+
+        # write config file for graphcut
+        if self.pred_format == 'binary':
+            write_pred(pred_file_path, self.max_label, self.label_cost, self.sigma_neighbor,
+                       self.sigma_predict, dup_id, edges)
+        else:
+            f = open(pred_file_path, 'w')
+            # info
+            f.write(pred_file_path + '\n')
+            f.write(self.data_path + '\n')
+            f.write('%d\n' % self.max_label)
+            f.write('%d\n' % self.label_cost)
+            f.write('%f\n' % self.sigma_neighbor)
+            f.write('%f\n' % self.sigma_predict)
+            # f.write('%d\n' % num_path_pixels)
+            f.write('%d\n' % dup_id)
+            np.savetxt(f, np.column_stack(edges), fmt='%d %d %f %f')
+            f.close()
+
         duration = time.time() - start_time
         print('%s: %s, prediction computed (%.3f sec)' % (datetime.now(), file_name, duration))
         pm.duration_map = duration
@@ -296,35 +317,41 @@ class Tester(object):
 
         return pm
 
+    def run_pathnet(self, y, img, query):
+        # full output maps, NHWC
+        y_b = self.sp.run(y, feed_dict={self.img: img, self.query: query})
+        y_b = np.clip(y_b, 0, 1)
+        if self.data_format == 'NCHW':
+            y_b = to_nhwc_numpy(y_b)
+        return y_b
+
     def extract_path(self, img):
+        """PathNet output for each marked path pixel, read at every path
+        pixel: affinity[i, j] is the output for pixel i at pixel j."""
         path_pixels = np.nonzero(img)
-        num_path_pixels = len(path_pixels[0]) 
+        num_path_pixels = len(path_pixels[0])
         assert(num_path_pixels > 0)
 
-        y_batch = None
+        query = np.transpose(path_pixels).astype(np.int32)
+        feed_dict = {self.img: img, self.target: query}
+        affinity_op = self.affinity
+        if self.delta_inference:
+            # outside rf_radius of the marked pixel, the output equals that
+            # of the unmarked image: compute it once, then run pathnet on a
+            # patch around each marked pixel
+            feed_dict[self.query] = [[-1, -1]]
+            feed_dict[self.base] = self.sp.run(self.affinity, feed_dict)[0]
+            affinity_op = self.affinity_delta
+
+        affinity = np.empty([num_path_pixels, num_path_pixels], dtype=self.affinity_dtype)
         for b in range(0,num_path_pixels,self.b_num):
-            b_size = min(self.b_num, num_path_pixels - b)
-            x_batch = np.zeros([b_size, self.height, self.width, 2])
-            for i in range(b_size):
-                x_batch[i,:,:,0] = img
-                px, py = path_pixels[0][b+i], path_pixels[1][b+i]
-                x_batch[i,px,py,1] = 1.0
-        
-            if self.data_format == 'NCHW':
-                x_batch = to_nchw_numpy(x_batch)
-            y_b = self.sp.run(self.yp, feed_dict={self.xp: x_batch})
-            y_b = np.clip(y_b, 0, 1)
-            if self.data_format == 'NCHW':
-                y_b = to_nhwc_numpy(y_b)
-            if y_batch is None:
-                y_batch = y_b
-            else:
-                y_batch = np.concatenate((y_batch, y_b), axis=0)
+            feed_dict[self.query] = query[b:b+self.b_num]
+            affinity[b:b+self.b_num] = self.sp.run(affinity_op, feed_dict)
 
-        return y_batch, path_pixels
+        return affinity, path_pixels
 
     def overlap(self, img):
-        x_batch = np.zeros([1, self.height, self.width, 1])
+        x_batch = np.zeros([1, self.height, self.width, 1], dtype=np.float32)
         x_batch[0,:,:,0] = img
         
         if self.data_format == 'NCHW':
@@ -391,6 +418,86 @@ class Tester(object):
             f.write('duration for vectorization: {}\n'.format(np.average(d_vec)))
             f.write('duration total: {}\n'.format(np.average(duration)))
 
+# binary .pred: header, then n_edges (i, j, pred, spatial) records,
+# little-endian, read back with one bulk read in gco/main.cpp.
+# text .pred files are still read by gco, see --pred_format
+PRED_MAGIC = b'VNPRED\0\0'
+PRED_VERSION = 1
+PRED_HEADER = np.dtype([('magic', 'S8'), ('version', '<i4'), ('n_labels', '<i4'),
+                        ('label_cost', '<i4'), ('sigma_neighbor', '<f4'),
+                        ('sigma_predict', '<f4'), ('n_sites', '<i4'), ('n_edges', '<i8')])
+PRED_EDGE = np.dtype([('i', '<i4'), ('j', '<i4'), ('pred', '<f4'), ('spatial', '<f4')])
+
+def write_pred(path, n_labels, label_cost, sigma_neighbor, sigma_predict, n_sites, edges):
+    header = np.array([(PRED_MAGIC, PRED_VERSION, n_labels, label_cost, sigma_neighbor,
+                        sigma_predict, n_sites, len(edges[0]))], dtype=PRED_HEADER)
+    records = np.empty(len(edges[0]), dtype=PRED_EDGE)
+    for name, c in zip(PRED_EDGE.names, edges):
+        records[name] = c
+    with open(path, 'wb') as f:
+        header.tofile(f)
+        records.tofile(f)
+
+def neighbor_pairs(path_pixels, radius, neighbor_sample, rng):
+    """Pairs i < j of each path pixel with its neighbors within radius and
+    a random sample of the farther ones, and their distance. Same pairs,
+    order and random draws as visiting the pixels one by one."""
+    points = np.transpose(path_pixels)
+    num_path_pixels = len(points)
+    if num_path_pixels < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    nb = sklearn.neighbors.NearestNeighbors(radius=radius)
+    nb.fit(points)
+    dist, ind = nb.radius_neighbors(points[:-1])
+
+    num_pair = np.zeros(num_path_pixels, dtype=np.int64)
+    pair_j, d12 = [], []
+    for i in range(num_path_pixels-1):
+        close = ind[i] > i
+        pair_j.append(ind[i][close])
+        d12.append(dist[i][close])
+        num_pair[i] = np.count_nonzero(close)
+
+        # the rest of j > i, sorted
+        far = np.ones(num_path_pixels-i-1, dtype=bool)
+        far[ind[i][close]-i-1] = False
+        far = np.arange(i+1, num_path_pixels)[far]
+        num_far = int(len(far) * neighbor_sample)
+        if num_far > 0:
+            far_ids = rng.choice(far, size=num_far)
+            pair_j.append(far_ids)
+            d12.append(np.sqrt(np.sum((points[far_ids] - points[i])**2, axis=1).astype(np.float64)))
+            num_pair[i] += num_far
+
+    pair_i = np.repeat(np.arange(num_path_pixels), num_pair)
+    return pair_i, np.concatenate(pair_j).astype(np.int64), np.concatenate(d12)
+
+def graph_edges(pair_i, pair_j, pred, spatial, dup, high_spatial=100000):
+    """Graphcut edges (i, j, pred, spatial) of the pixel pairs. A duplicated
+    pixel (dup >= 0) links its duplicate to the other pixel and is kept
+    apart from it, edges are in the order of the pairs."""
+    dup_i, dup_j = dup[pair_i], dup[pair_j]
+    has_i, has_j = dup_i >= 0, dup_j >= 0
+    zero, high = np.zeros_like(pred), np.full_like(spatial, high_spatial)
+
+    # per pair: the pair, then the edges of its duplicates
+    # (dup is always larger than a normal id)
+    slots = [
+        (np.ones_like(has_i), pair_i, pair_j, pred, spatial),
+        (has_i, pair_j, dup_i, pred, spatial),
+        (has_i, pair_i, dup_i, zero, high), # shouldn't be labeled together
+        (has_j, pair_i, dup_j, pred, spatial),
+        (has_j, pair_j, dup_j, zero, high),
+        (np.logical_and(has_i, has_j), dup_i, dup_j, pred, spatial),
+    ]
+    key, edges = [], []
+    for k, (mask, i, j, p, s) in enumerate(slots):
+        key.append(np.nonzero(mask)[0] * len(slots) + k)
+        edges.append((i[mask], j[mask], p[mask], s[mask]))
+    order = np.argsort(np.concatenate(key))
+    return [np.concatenate(c)[order] for c in zip(*edges)]
+
 def vectorize(pm):
     start_time = time.time()
     file_path = os.path.basename(pm.file_path)
@@ -433,6 +540,21 @@ def vectorize(pm):
             pm.duration_pred, pm.duration_ov, pm.duration_map, 
             pm.duration_vect, pm.duration))
 
+def gco_command():
+    # relative to gco/build
+    if platform.system() == 'Windows':
+        return ['Release/gco.exe']
+    return ['./gco']
+
+def gco_pred_version():
+    # binary pred format version gco reads, 0: text only or not built
+    try:
+        out = check_output(gco_command() + ['--pred_version'],
+                           cwd=os.path.join(os.getcwd(), 'gco/build'))
+        return int(out.split()[0])
+    except (OSError, CalledProcessError, ValueError, IndexError):
+        return 0
+
 def label(file_name, pm):
     start_time = time.time()
     working_path = os.getcwd()
@@ -440,11 +562,7 @@ def label(file_name, pm):
     os.chdir(gco_path)
 
     pred_file_path = os.path.join(working_path, pm.model_dir, 'tmp', file_name + '.pred')        
-    sys_name = platform.system()
-    if sys_name == 'Windows':
-        call(['Release/gco.exe', pred_file_path])
-    else:
-        call(['./gco', pred_file_path])
+    call(gco_command() + [pred_file_path])
     os.chdir(working_path)
 
     # read graphcut result
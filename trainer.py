@@ -1,20 +1,55 @@
 from __future__ import print_function
 
 import os
+import sys
+import time
+import subprocess
 import numpy as np
-from tqdm import trange
+from datetime import datetime
+from tqdm import tqdm
 
 from models import *
 from utils import save_image
+from checkpoint import AsyncSaver
+
+def evaluate(sess, test_set, xt, yt, metrics, batch_size, data_format):
+    """l1, l2 accuracy and iou over a cached test set, metrics from test_metrics()."""
+    update, reset, result = metrics
+    sess.run(reset)
+    for x, y in test_set.batches(batch_size):
+        if data_format == 'NCHW':
+            x = to_nchw_numpy(x)
+            y = to_nchw_numpy(y)
+        sess.run(update, {xt: x, yt: y})
+    return tuple(sess.run(result))
+
+# written to model_dir once the last checkpoint is saved
+DONE_FILE = 'train_done'
+
+# ops that hand a batch from the input pipeline to the model
+DEQUEUE_OPS = ['QueueDequeueV2', 'QueueDequeueManyV2', 'QueueDequeueUpToV2', 'IteratorGetNext']
+
+def cluster_spec(config):
+    return tf.train.ClusterSpec({
+        'ps': config.ps_hosts.split(','),
+        'worker': config.worker_hosts.split(','),
+    })
 
 class Trainer(object):
     def __init__(self, config, batch_manager):
         tf.set_random_seed(config.random_seed)
         self.config = config
         self.batch_manager = batch_manager
-        self.x, self.y = batch_manager.batch()
-        self.xt = tf.placeholder(tf.float32, shape=int_shape(self.x))
-        self.yt = tf.placeholder(tf.float32, shape=int_shape(self.y))
+        # joint: PathNet and OverlapNet trained on the same sample stream
+        self.is_joint = (config.archi == 'joint')
+        if self.is_joint:
+            self.x, self.y, self.xo, self.yo = batch_manager.batch()
+            self.xot = tf.placeholder(tf.float32, shape=[None] + int_shape(self.xo)[1:])
+            self.yot = tf.placeholder(tf.float32, shape=[None] + int_shape(self.yo)[1:])
+        else:
+            self.x, self.y = batch_manager.batch()
+        self.xt = tf.placeholder(tf.float32, shape=[None] + int_shape(self.x)[1:])
+        self.yt = tf.placeholder(tf.float32, shape=[None] + int_shape(self.y)[1:])
         self.dataset = config.dataset
 
         self.beta1 = config.beta1
@@ -28,6 +63,10 @@ class Trainer(object):
         self.height = config.height
         self.width = config.width
         self.b_num = config.batch_size
+        # gradients summed over num_accum micro-batches per Adam step,
+        # steps and lr schedule count Adam steps (effective batches)
+        self.num_accum = config.num_accum
+        self.steps_per_run = config.steps_per_run
         self.conv_hidden_num = config.conv_hidden_num
         self.repeat_num = config.repeat_num
         self.use_l2 = config.use_l2
@@ -42,50 +81,123 @@ class Trainer(object):
             self.y = nhwc_to_nchw(self.y)
             self.xt = nhwc_to_nchw(self.xt)
             self.yt = nhwc_to_nchw(self.yt)
+            if self.is_joint:
+                self.xo = nhwc_to_nchw(self.xo)
+                self.yo = nhwc_to_nchw(self.yo)
+                self.xot = nhwc_to_nchw(self.xot)
+                self.yot = nhwc_to_nchw(self.yot)
 
         self.start_step = config.start_step
         self.log_step = config.log_step
         self.test_step = config.test_step
+        self.eval_batch_size = config.eval_batch_size
+        self.async_eval = config.async_eval
+        self.eval_timeout = config.eval_timeout
+        self.eval_proc = None
         self.max_step = config.max_step
         self.save_sec = config.save_sec
+        self.async_save = config.async_save
         self.lr_update_step = config.lr_update_step
 
         self.step = tf.Variable(self.start_step, name='step', trainable=False)
 
+        # synchronous data-parallel: each worker process feeds its own batches,
+        # gradients are averaged over all workers before each Adam update
+        self.is_sync = bool(config.worker_hosts)
+        self.num_replica = len(config.worker_hosts.split(',')) if self.is_sync else 1
+        self.is_chief = (config.task_index == 0) or not self.is_sync
+        # local variables stay on the worker, not shared through the ps
+        self.worker_device = '/job:worker/task:%d' % config.task_index if self.is_sync else None
+
         self.is_train = config.is_train
         self.build_model()
 
-        self.saver = tf.train.Saver()
+        self.saver = tf.train.Saver(max_to_keep=config.max_to_keep)
+        self.save_path = os.path.join(self.model_dir, 'model.ckpt')
+        if self.async_save and self.is_chief:
+            # the Supervisor only restores, the loop snapshots every save_sec
+            self.async_saver = AsyncSaver(tf.global_variables(), config.max_to_keep)
+            save_model_secs = 0
+        else:
+            self.async_saver = None
+            save_model_secs = self.save_sec
         self.summary_writer = tf.summary.FileWriter(self.model_dir)
 
+        gpu_options = tf.GPUOptions(allow_growth=True)
+        sess_config = tf.ConfigProto(allow_soft_placement=True,
+                                    intra_op_parallelism_threads=config.num_thread,
+                                    gpu_options=gpu_options)
+
+        if self.is_sync:
+            # only talk to the ps and this worker
+            sess_config.device_filters.extend(
+                ['/job:ps', '/job:worker/task:%d' % config.task_index])
+            self.server = tf.train.Server(cluster_spec(config), job_name='worker',
+                                          task_index=config.task_index, config=sess_config)
+            target = self.server.target
+            if self.is_chief:
+                local_init_op = self.optim_sync.chief_init_op
+            else:
+                local_init_op = self.optim_sync.local_step_init_op
+            # tf.group has no order, so the local variables initializer could
+            # reset the sync local step after the op above: set it again once
+            # the initializer is done
+            local_step = [v for v in tf.local_variables()
+                          if v.op.name.endswith('sync_rep_local_step')][0]
+            with tf.control_dependencies([tf.local_variables_initializer()]):
+                local_step_init = tf.assign(local_step, self.step)
+            local_init_op = tf.group(local_init_op, local_step_init)
+            ready_for_local_init_op = self.optim_sync.ready_for_local_init_op
+        else:
+            target = ''
+            local_init_op = tf.train.Supervisor.USE_DEFAULT
+            ready_for_local_init_op = None
+
         sv = tf.train.Supervisor(logdir=self.model_dir,
-                                is_chief=True,
+                                is_chief=self.is_chief,
                                 saver=self.saver,
                                 summary_op=None,
                                 summary_writer=self.summary_writer,
-                                save_model_secs=self.save_sec,
+                                save_model_secs=save_model_secs,
                                 global_step=self.step,
-                                ready_for_local_init_op=None)
+                                local_init_op=local_init_op,
+                                ready_for_local_init_op=ready_for_local_init_op)
 
-        gpu_options = tf.GPUOptions(allow_growth=True)
-        sess_config = tf.ConfigProto(allow_soft_placement=True,
-                                    gpu_options=gpu_options)
+        self.sv = sv
+        self.sess = sv.prepare_or_wait_for_session(target, config=sess_config)
+        if self.is_sync and self.is_chief:
+            sv.start_queue_runners(self.sess, [self.optim_sync.get_chief_queue_runner()])
+            self.sess.run(self.init_tokens)
 
-        self.sess = sv.prepare_or_wait_for_session(config=sess_config)
         if self.is_train:
+            if self.is_chief and self.async_eval:
+                self.start_evaluator()
+            elif self.is_chief:
+                self.batch_manager.prefetch_test_set()
             self.batch_manager.start_thread(self.sess)
 
     def build_model(self):
+        name = 'PathNet' if self.is_joint else 'VDSR'
         self.y_, self.var = VDSR(
-                self.x, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm)
+                self.x, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
+                name=name)
         self.y_img = denorm_img(self.y_, self.data_format) # for debug
 
         self.yt_, _ = VDSR(
                 self.xt, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
-                train=False, reuse=True)
+                name=name, train=False, reuse=True)
         self.yt_ = tf.clip_by_value(self.yt_, 0, 1)
         self.yt_img = denorm_img(self.yt_, self.data_format)
 
+        if self.is_joint:
+            self.yo_, self.var_o = VDSR(
+                    self.xo, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
+                    name='OverlapNet')
+            self.yot_, _ = VDSR(
+                    self.xot, self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
+                    name='OverlapNet', train=False, reuse=True)
+            self.yot_ = tf.clip_by_value(self.yot_, 0, 1)
+
         show_all_variables()        
 
         if self.optimizer == 'adam':
@@ -94,6 +206,11 @@ class Trainer(object):
             raise Exception("[!] Caution! Paper didn't use {} opimizer other than Adam".format(self.config.optimizer))
 
         optimizer = optimizer(self.lr, beta1=self.beta1, beta2=self.beta2)
+        if self.is_sync:
+            optimizer = tf.train.SyncReplicasOptimizer(optimizer,
+                                                       replicas_to_aggregate=self.num_replica,
+                                                       total_num_replicas=self.num_replica)
+            self.optim_sync = optimizer
 
         # losses
         # l1 and l2
@@ -107,13 +224,43 @@ class Trainer(object):
             self.loss = self.loss_l1
 
         # test loss
-        self.tl1 = 1 - tf.reduce_mean(tf.abs(self.yt_ - self.yt))
-        self.tl2 = 1 - tf.reduce_mean(tf.squared_difference(self.yt_, self.yt))
+        with tf.device(self.worker_device):
+            self.test_metrics = test_metrics(self.yt_, self.yt)
         self.test_acc_l1 = tf.placeholder(tf.float32)
         self.test_acc_l2 = tf.placeholder(tf.float32)
         self.test_acc_iou = tf.placeholder(tf.float32)
 
-        self.optim = optimizer.minimize(self.loss, global_step=self.step, var_list=self.var)
+        var = self.var
+        if self.is_joint:
+            # disjoint variables, so one Adam on the sum trains each net on its own loss
+            self.loss_o_l1 = tf.reduce_mean(tf.abs(self.yo_ - self.yo))
+            self.loss_o_l2 = tf.reduce_mean(tf.squared_difference(self.yo_, self.yo))
+            self.loss_o = self.loss_o_l2 if self.use_l2 else self.loss_o_l1
+            self.loss_p = self.loss
+            self.loss = self.loss_p + self.loss_o
+            var = self.var + self.var_o
+
+            with tf.device(self.worker_device):
+                self.test_metrics_o = test_metrics(self.yot_, self.yot, name='test_metrics_overlap')
+            self.test_acc_o_l1 = tf.placeholder(tf.float32)
+            self.test_acc_o_l2 = tf.placeholder(tf.float32)
+            self.test_acc_o_iou = tf.placeholder(tf.float32)
+
+        if self.num_accum > 1:
+            self.build_accum(optimizer, var)
+        else:
+            self.optim = optimizer.minimize(self.loss, global_step=self.step, var_list=var)
+
+        if self.steps_per_run > 1:
+            if self.is_sync or self.num_accum > 1:
+                raise Exception("[!] steps_per_run > 1 works with neither worker_hosts nor num_accum > 1")
+            self.build_loop(optimizer, var)
+
+        if self.is_sync:
+            # built before the Supervisor finalizes the graph: initial tokens,
+            # and extra tokens handed out by the chief once it is done
+            self.init_tokens = self.optim_sync.get_init_tokens_op()
+            self.release_tokens = self.optim_sync.get_init_tokens_op(num_tokens=self.num_replica)
  
         summary = [
             tf.summary.image("y", self.y_img),
@@ -123,8 +270,17 @@ class Trainer(object):
             tf.summary.scalar("loss/loss_l2", self.loss_l2),
            
             tf.summary.scalar("misc/lr", self.lr),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size())
         ]
+        if self.batch_manager.q is not None:
+            summary.append(tf.summary.scalar('misc/q', self.batch_manager.q.size()))
+        if self.is_joint:
+            summary += [
+                tf.summary.image("yo", denorm_img(self.yo_, self.data_format)),
+                tf.summary.scalar("loss/loss_path", self.loss_p),
+                tf.summary.scalar("loss/loss_overlap", self.loss_o),
+                tf.summary.scalar("loss/loss_overlap_l1", self.loss_o_l1),
+                tf.summary.scalar("loss/loss_overlap_l2", self.loss_o_l2),
+            ]
 
         self.summary_op = tf.summary.merge(summary)
 
@@ -132,6 +288,11 @@ class Trainer(object):
             tf.summary.image("x_sample", denorm_img(self.x, self.data_format)),
             tf.summary.image("y_sample", denorm_img(self.y, self.data_format)),
         ]
+        if self.is_joint:
+            summary += [
+                tf.summary.image("xo_sample", denorm_img(self.xo, self.data_format)),
+                tf.summary.image("yo_sample", denorm_img(self.yo, self.data_format)),
+            ]
 
         self.summary_once = tf.summary.merge(summary) # call just once
 
@@ -140,92 +301,315 @@ class Trainer(object):
             tf.summary.scalar("loss/test_acc_l2", self.test_acc_l2),
             tf.summary.scalar("loss/test_acc_iou", self.test_acc_iou),
         ]
+        if self.is_joint:
+            summary += [
+                tf.summary.scalar("loss/test_acc_overlap_l1", self.test_acc_o_l1),
+                tf.summary.scalar("loss/test_acc_overlap_l2", self.test_acc_o_l2),
+                tf.summary.scalar("loss/test_acc_overlap_iou", self.test_acc_o_iou),
+            ]
 
         self.summary_test = tf.summary.merge(summary)
 
-    def train(self):
-        x_list, xs, ys, sample_list = self.batch_manager.random_list(self.b_num)
-        save_image(xs, '{}/x_gt.png'.format(self.model_dir))
-        save_image(ys, '{}/y_gt.png'.format(self.model_dir))
+        # throughput, fed from step timers and the producer counter
+        self.perf = dict((name, tf.placeholder(tf.float32)) for name in [
+            'time/step_ms', 'time/dequeue_ms', 'time/compute_ms', 'time/summary_ms', 'time/eval_sec',
+            'perf/examples_per_sec'])
+        self.producer_rate = tf.placeholder(tf.float32, [self.batch_manager.counter.num_worker])
+        summary = [tf.summary.scalar(name, self.perf[name]) for name in sorted(self.perf)]
+        summary.append(tf.summary.scalar('producer/%s/samples_per_sec' % self.dataset,
+                                         tf.reduce_sum(self.producer_rate)))
+        summary += [tf.summary.scalar('producer/%s/worker_%d' % (self.dataset, i), self.producer_rate[i])
+                    for i in range(self.batch_manager.counter.num_worker)]
+        self.summary_perf = tf.summary.merge(summary)
+        self.dequeue_ops = set(op.name for op in tf.get_default_graph().get_operations()
+                               if op.type in DEQUEUE_OPS)
+
+    def build_loop(self, optimizer, var):
+        # num_loop optimizer steps in one sess.run, each on a freshly dequeued
+        # batch, returns the loss of the last one. reuses the variables and
+        # Adam slots created above
+        name = 'PathNet' if self.is_joint else 'VDSR'
+        def body(i, _):
+            batch = self.batch_manager.batch()
+            if self.data_format == 'NCHW':
+                batch = [nhwc_to_nchw(t) for t in batch]
+            y_, _ = VDSR(
+                    batch[0], self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
+                    name=name, reuse=True)
+            if self.use_l2:
+                loss = tf.reduce_mean(tf.squared_difference(y_, batch[1]))
+            else:
+                loss = tf.reduce_mean(tf.abs(y_ - batch[1]))
+
+            if self.is_joint:
+                yo_, _ = VDSR(
+                        batch[2], self.conv_hidden_num, self.repeat_num, self.data_format, self.use_norm,
+                        name='OverlapNet', reuse=True)
+                if self.use_l2:
+                    loss += tf.reduce_mean(tf.squared_difference(yo_, batch[3]))
+                else:
+                    loss += tf.reduce_mean(tf.abs(yo_ - batch[3]))
+
+            optim = optimizer.minimize(loss, global_step=self.step, var_list=var)
+            with tf.control_dependencies([optim]):
+                return i + 1, tf.identity(loss)
+
+        self.num_loop = tf.placeholder(tf.int32, [])
+        _, self.loop_loss = tf.while_loop(lambda i, _: i < self.num_loop, body,
+                                          [tf.constant(0), tf.constant(0.0)],
+                                          parallel_iterations=1, back_prop=False)
+
+    def build_accum(self, optimizer, var):
+        # per worker accumulators
+        with tf.device(self.worker_device):
+            accum = [tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype),
+                                 name=v.op.name.replace('/', '_') + '_accum', trainable=False,
+                                 collections=[tf.GraphKeys.LOCAL_VARIABLES]) for v in var]
+
+        grads = [g for g, _ in optimizer.compute_gradients(self.loss, var_list=var)]
+        self.accum = tf.group(*[a.assign_add(g) for a, g in zip(accum, grads)])
+
+        # the last micro-batch is added, then the mean is applied and the sums cleared
+        with tf.control_dependencies([self.accum]):
+            mean = [(a.read_value() / self.num_accum, v) for a, v in zip(accum, var)]
+            apply = optimizer.apply_gradients(mean, global_step=self.step)
+        with tf.control_dependencies([apply]):
+            self.optim = tf.group(*[a.assign(tf.zeros_like(a)) for a in accum])
+
+    def log_perf(self, step, perf):
+        # mean times over the log interval, dequeue and compute from a traced step
+        num_step = max(perf['num_step'], 1)
+        step_time = perf['step'] / num_step
+        feed = {
+            'time/step_ms': step_time * 1000,
+            'time/dequeue_ms': perf['dequeue'] * 1000,
+            'time/compute_ms': perf['compute'] * 1000,
+            'time/summary_ms': max(perf['log'] - step_time, 0) * 1000 + perf['summary'] * 1000,
+            'time/eval_sec': perf['eval'],
+            'perf/examples_per_sec': perf['num_run'] * self.b_num * self.num_accum * self.num_replica /
+                                     max(time.time() - perf['start'], 1e-6),
+        }
+        producer_rate = self.batch_manager.counter.rates()
+
+        print('%s: %.1f examples/sec, step %.1f ms (dequeue %.1f, compute %.1f), '
+              'summary %.1f ms, eval %.1f sec, producer %.1f samples/sec' % (
+            datetime.now(), feed['perf/examples_per_sec'], feed['time/step_ms'],
+            feed['time/dequeue_ms'], feed['time/compute_ms'], feed['time/summary_ms'],
+            feed['time/eval_sec'], np.sum(producer_rate)))
+
+        if self.is_chief:
+            feed_dict = dict((self.perf[name], v) for name, v in feed.items())
+            feed_dict[self.producer_rate] = producer_rate
+            summary_perf = self.sess.run(self.summary_perf, feed_dict)
+            self.summary_writer.add_summary(summary_perf, step)
+            self.summary_writer.flush()
+
+    def trace_dequeue(self, run_metadata):
+        # seconds spent in dequeue ops of a traced step
+        dequeue = 0
+        for dev_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                if node_stats.node_name in self.dequeue_ops:
+                    dequeue += node_stats.all_end_rel_micros / 1e6
+        return dequeue
 
-        with open('{}/gt.txt'.format(self.model_dir), 'w') as f:
-            for sample in sample_list:
-                f.write(sample + '\n')
+    def train(self):
+        if self.is_chief:
+            x_list, xs, ys, sample_list = self.batch_manager.random_list(self.b_num)
+            save_image(xs, '{}/x_gt.png'.format(self.model_dir))
+            save_image(ys, '{}/y_gt.png'.format(self.model_dir))
+
+            with open('{}/gt.txt'.format(self.model_dir), 'w') as f:
+                for sample in sample_list:
+                    f.write(sample + '\n')
         
-        # call once
-        summary_once = self.sess.run(self.summary_once)
-        self.summary_writer.add_summary(summary_once, 0)
-        self.summary_writer.flush()
+            # call once
+            summary_once = self.sess.run(self.summary_once)
+            self.summary_writer.add_summary(summary_once, 0)
+            self.summary_writer.flush()
+
+        # training throughput, first step (graph warmup) excluded
+        train_time, train_step = 0, 0
+        last_save = time.time()
+
+        # per log interval: plain steps, the log step, summary writing, evaluation
+        def new_perf():
+            return {'start': time.time(), 'num_run': 0, 'num_step': 0, 'step': 0, 'log': 0,
+                    'summary': 0, 'eval': 0, 'dequeue': 0, 'compute': 0}
+        perf = new_perf()
+        trace_options = tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE)
+
+        # steps with a log, trace, test, sample or lr update run alone,
+        # runs of plain steps between them in chunks of steps_per_run
+        def is_event(step):
+            return (step % self.log_step in [0, self.log_step-1] or
+                    step % self.test_step == self.test_step-1 or
+                    step % self.lr_update_step == self.lr_update_step-1 or
+                    step == self.max_step-1)
+
+        # sync: a worker's run advances the global step by zero (stale gradients
+        # dropped) or several steps, so every worker follows the global step
+        # and stops at max_step, decays and logs key off it too
+        step = self.sess.run(self.step) if self.is_sync else self.start_step
+        first_step = step
+        pbar = tqdm(total=self.max_step, initial=step)
+        while step < self.max_step and not self.sv.should_stop():
+            if self.steps_per_run > 1 and not is_event(step):
+                num_loop = 1
+                while (num_loop < self.steps_per_run and step+num_loop < self.max_step and
+                       not is_event(step+num_loop)):
+                    num_loop += 1
+
+                t = time.time()
+                loss = self.sess.run(self.loop_loss, {self.num_loop: num_loop})
+                run_time = time.time() - t
+                assert not np.isnan(loss), 'Model diverged with loss = NaN'
+
+                if step > first_step:
+                    train_time += run_time
+                    train_step += num_loop
+                    perf['step'] += run_time
+                    perf['num_step'] += num_loop
+                perf['num_run'] += num_loop
+                if self.async_saver is not None and time.time() - last_save >= self.save_sec:
+                    self.async_saver.save(self.sess, self.save_path, self.step)
+                    last_save = time.time()
+                pbar.update(num_loop)
+                step += num_loop
+                continue
 
-        for step in trange(self.start_step, self.max_step):
             fetch_dict = {
                 "optim": self.optim,
                 "loss": self.loss,
             }           
 
-            if step % self.log_step == 0 or step == self.max_step-1:
+            # summaries, tests and checkpoints are the chief's job
+            is_log = self.is_chief and (step % self.log_step == 0 or step == self.max_step-1)
+            # trace the plain step before each log step
+            is_trace = (step % self.log_step == self.log_step-1) and not is_log
+            if is_log:
                 fetch_dict.update({
                     "summary": self.summary_op,                    
                 })
 
-            if step % self.test_step == self.test_step-1 or step == self.max_step-1:
-                l1, l2, iou, nb = 0, 0, 0, 0
-                for x, y in self.batch_manager.test_batch():
-                    if self.data_format == 'NCHW':
-                        x = to_nchw_numpy(x)
-                        y = to_nchw_numpy(y)
-                    tl1, tl2, y_ = self.sess.run([self.tl1, self.tl2, self.yt_], {self.xt: x, self.yt: y})
-                    l1 += tl1
-                    l2 += tl2
-                    nb += 1
-
-                    # iou
-                    y_I = np.logical_and(y>0, y_>0)
-                    y_I_sum = np.sum(y_I, axis=(1, 2, 3))
-                    y_U = np.logical_or(y>0, y_>0)
-                    y_U_sum = np.sum(y_U, axis=(1, 2, 3))
-                    # print(y_I_sum, y_U_sum)
-                    nonzero_id = np.where(y_U_sum != 0)[0]
-                    if nonzero_id.shape[0] == 0:
-                        acc = 1.0
-                    else:
-                        acc = np.average(y_I_sum[nonzero_id] / y_U_sum[nonzero_id])
-                    iou += acc
-
-                    if nb > 500:
-                        break
-
-                l1 /= float(nb)
-                l2 /= float(nb)
-                iou /= float(nb)
-                    
-                summary_test = self.sess.run(self.summary_test, 
-                              {self.test_acc_l1: l1, self.test_acc_l2: l2, self.test_acc_iou: iou})
+            if self.is_chief and not self.async_eval and \
+               (step % self.test_step == self.test_step-1 or step == self.max_step-1):
+                t = time.time()
+                l1, l2, iou = self.test()
+                feed_dict = {self.test_acc_l1: l1, self.test_acc_l2: l2, self.test_acc_iou: iou}
+                if self.is_joint:
+                    l1, l2, iou = self.test('overlap')
+                    feed_dict.update({self.test_acc_o_l1: l1, self.test_acc_o_l2: l2,
+                                      self.test_acc_o_iou: iou})
+                summary_test = self.sess.run(self.summary_test, feed_dict)
                 self.summary_writer.add_summary(summary_test, step)
                 self.summary_writer.flush()
-
-            result = self.sess.run(fetch_dict)
-
-            if step % self.log_step == 0 or step == self.max_step-1:
+                perf['eval'] += time.time() - t
+
+            t = time.time()
+            for _ in range(self.num_accum - 1):
+                self.sess.run(self.accum)
+            if is_trace:
+                run_metadata = tf.RunMetadata()
+                result = self.sess.run(fetch_dict, options=trace_options, run_metadata=run_metadata)
+            else:
+                result = self.sess.run(fetch_dict)
+            run_time = time.time() - t
+            next_step = self.sess.run(self.step) if self.is_sync else step + 1
+            if step > first_step:
+                train_time += run_time
+                train_step += next_step - step
+
+            if is_trace:
+                perf['dequeue'] = self.trace_dequeue(run_metadata)
+                perf['compute'] = max(run_time - perf['dequeue'], 0)
+            if is_log:
+                perf['log'] = run_time
+            elif step > first_step:
+                perf['step'] += run_time
+                perf['num_step'] += 1
+
+            if is_log:
+                t = time.time()
                 self.summary_writer.add_summary(result['summary'], step)
                 self.summary_writer.flush()
+                perf['summary'] = time.time() - t
 
                 loss = result['loss']
                 assert not np.isnan(loss), 'Model diverged with loss = NaN'
 
                 print("\n[{}/{}] Loss: {:.6f}".format(step, self.max_step, loss))
 
-            if step % (self.log_step * 10) == 0 or step == self.max_step-1:
+            perf['num_run'] += 1
+            if step % self.log_step == 0 and step > first_step:
+                self.log_perf(step, perf)
+                perf = new_perf()
+
+            if self.is_chief and (step % (self.log_step * 10) == 0 or step == self.max_step-1):
                 self.generate(x_list, self.model_dir, idx=step)
 
-            if step % self.lr_update_step == self.lr_update_step - 1:
-                self.sess.run(self.lr_update)
+            # lr is shared, decayed once for all workers per lr_update_step global steps
+            if self.is_chief:
+                for _ in range(next_step // self.lr_update_step - step // self.lr_update_step):
+                    self.sess.run(self.lr_update)
+
+            if self.async_saver is not None and time.time() - last_save >= self.save_sec:
+                self.async_saver.save(self.sess, self.save_path, self.step)
+                last_save = time.time()
+
+            pbar.update(next_step - step)
+            step = next_step
+        pbar.close()
+
+        if self.is_sync and self.is_chief:
+            # workers waiting for a token of the last update can see max_step and exit
+            self.sess.run(self.release_tokens)
+
+        if train_time > 0:
+            print('%s: %d steps in %.1f sec, %.2f steps/sec, %.1f samples/sec (%d workers)' % (
+                datetime.now(), train_step, train_time, train_step / train_time,
+                train_step * self.b_num * self.num_accum * self.num_replica / train_time,
+                self.num_replica))
 
         # save last checkpoint..
-        save_path = os.path.join(self.model_dir, 'model.ckpt')
-        self.saver.save(self.sess, save_path, global_step=self.step)
+        if self.async_saver is not None:
+            self.async_saver.save(self.sess, self.save_path, self.step)
+            self.async_saver.close()
+        elif self.is_chief:
+            self.saver.save(self.sess, self.save_path, global_step=self.step)
         self.batch_manager.stop_thread()
 
+        if self.eval_proc is not None:
+            # the evaluator stops after the last checkpoint, see Evaluator.run
+            open(os.path.join(self.model_dir, DONE_FILE), 'w').close()
+            try:
+                self.eval_proc.wait(timeout=self.eval_timeout)
+            except subprocess.TimeoutExpired:
+                print('%s: evaluator timed out, terminated' % datetime.now())
+                self.eval_proc.terminate()
+                self.eval_proc.wait()
+
+    def start_evaluator(self):
+        # same arguments, single process, pointed at this model_dir
+        args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')] + sys.argv[1:] + [
+            '--eval_dir=' + os.path.abspath(self.model_dir), '--worker_hosts=']
+        done_path = os.path.join(self.model_dir, DONE_FILE)
+        if os.path.exists(done_path):
+            os.remove(done_path)
+        print('%s: start evaluator on %s' % (datetime.now(), self.model_dir))
+        self.eval_proc = subprocess.Popen(args)
+
+    def test(self, archi=None):
+        # cached test set, fixed query pixels, large batches
+        if archi == 'overlap':
+            xt, yt, metrics = self.xot, self.yot, self.test_metrics_o
+        else:
+            xt, yt, metrics = self.xt, self.yt, self.test_metrics
+        if self.is_joint:
+            archi = archi or 'path'
+        return evaluate(self.sess, self.batch_manager.test_set(archi), xt, yt, metrics,
+                        self.eval_batch_size, self.data_format)
+
     def generate(self, x_samples, root_path=None, idx=None):
         if self.data_format == 'NCHW':
             x_samples = to_nchw_numpy(x_samples)
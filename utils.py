@@ -30,7 +30,10 @@ def prepare_dirs_and_logger(config):
     config.data_path = os.path.join(config.data_dir, config.dataset)
 
     # model path
-    if config.is_train:
+    if config.is_train and config.eval_dir:
+        # evaluation process of a running training
+        config.model_dir = config.eval_dir
+    elif config.is_train:
         model_name = os.path.join(config.archi, '{}_{}_{}'.format(
             config.dataset, get_time(), config.tag))
         config.model_dir = os.path.join(config.log_dir, model_name)    
@@ -114,6 +117,12 @@ def convert_png2mp4(imgdir, filename, fps, delete_imgdir=False):
 def rf(o, k, stride): # input size from output size
     return (o-1)*stride + k
 
+def conv_receptive_field_size(num_conv, k): # stride 1 convs
+    rfs = 1
+    for _ in range(num_conv):
+        rfs = rf(rfs, k, 1)
+    return rfs
+
 def receptive_field_size(c, k, s):
     if c == 0:
         return rf(rf(1, k, 1), k, 1)